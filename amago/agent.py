@@ -2,12 +2,12 @@
 # fmt: off
 # test
 # test2
+import contextlib
 from itertools import chain
 
 import torch
 from torch import nn
 import torch.nn.functional as F
-from einops import repeat, rearrange
 import numpy as np
 import wandb
 import gin
@@ -36,6 +36,89 @@ class Multigammas:
         self.continuous = continuous
 
 
+def redq_random_subset(B: int, L: int, num_critics: int, k: int, device):
+    """
+    Draw `k` distinct critic indices for every (B, L) position by taking the
+    head of a random permutation of the ensemble --> (B, L, k, 1, 1). Returns
+    None when the "subset" would be the full ensemble.
+    """
+    if k >= num_critics:
+        return None
+    perm = torch.rand(B, L, num_critics, device=device).argsort(-1)
+    return perm[..., :k, None, None]
+
+
+def redq_td_target(
+    r, d, gamma, q_targ, random_subset, clipped: bool, dtype=torch.float32
+):
+    """
+    (B, L, C, G, 1) ensemble TD targets --> random subset --> (B, L, 1, G, 1).
+    Kept as a pure function of tensors so that it can be fused by `torch.compile`.
+    The ensemble arithmetic runs in `dtype`; the result is always fp32.
+    """
+    r, d, gamma, q_targ = (x.to(dtype) for x in (r, d, gamma, q_targ))
+    ensemble_td_target = r + gamma * (1.0 - d) * q_targ
+    if random_subset is None:
+        td_target_rand = ensemble_td_target
+    else:
+        td_target_rand = torch.gather(
+            ensemble_td_target,
+            2,
+            random_subset.expand(-1, -1, -1, *ensemble_td_target.shape[3:]),
+        )
+    if clipped:
+        return td_target_rand.min(2, keepdims=True).values.float()
+    return td_target_rand.mean(2, keepdims=True).float()
+
+
+def two_hot_td_target(
+    r, d, gamma, q_targ_probs, random_subset, bin_vals, dtype=torch.float32
+):
+    """
+    (B, L, C, G, Bins) target critic bins --> raw values --> REDQ ensemble TD target
+    (B, L, 1, G, 1) and its (B, L, 1, G, Bins) two-hot labels, as one fusable function.
+    """
+    q_targ = actor_critic.bin_probs_to_raw_vals(q_targ_probs, bin_vals)
+    td_target = redq_td_target(
+        r, d, gamma, q_targ, random_subset, clipped=False, dtype=dtype
+    )
+    return td_target, actor_critic.raw_vals_to_two_hot(td_target, bin_vals)
+
+
+def filtered(filter_: Optional[torch.Tensor], x: torch.Tensor) -> torch.Tensor:
+    """
+    Weight `x` by a detached FBC filter; `None` means no filter (behavior cloning).
+    """
+    return x if filter_ is None else filter_.detach() * x
+
+
+def two_hot_cross_entropy(td_target_labels, logp):
+    """
+    (B, L, 1, G, Bins) two-hot labels and (B, L, C, G, Bins) log-probs -->
+    (B, L, C, G, 1) soft-label cross-entropy. The labels broadcast over the critic dim.
+    """
+    return -(td_target_labels * logp).sum(-1, keepdim=True)
+
+
+def drop_maximized_critics_keys(state_dict, prefix, *args):
+    """
+    Load-state-dict pre-hook for checkpoints saved before `Agent.maximized_critics`
+    became a method: they hold a redundant copy of the online critics under that name.
+    """
+    legacy = prefix + "maximized_critics."
+    for k in [k for k in state_dict.keys() if k.startswith(legacy)]:
+        del state_dict[k]
+
+
+def masked_avg_per_gamma(x_: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """
+    Masked mean of every gamma at once. Gammas are the -2 dim of
+    (B, L, G, 1) and (B, L, C, G, 1) arrays --> (G,)
+    """
+    dims = tuple(d for d in range(mask.ndim) if d != mask.ndim - 2)
+    return (mask * x_).sum(dims).detach() / mask.sum(dims)
+
+
 @gin.configurable
 class Agent(nn.Module):
     def __init__(
@@ -68,6 +151,11 @@ class Agent(nn.Module):
         popart: bool = True,
         use_target_actor: bool = True,
         use_multigamma: bool = True,
+        compile_td_target: bool = False,
+        bf16_td_target: bool = False,
+        td_target_stream: bool = True,
+        cuda_graph_rollouts: bool = False,
+        mixed_precision: Literal["no", "bf16"] = "no",
     ):
         super().__init__()
         self.name = "Amago"
@@ -93,6 +181,13 @@ class Agent(nn.Module):
                 raise ValueError(f"Unsupported action space: `{type(self.action_space)}`")
         else:
             self.action_dim = action_dim
+        # the action space is fixed, so pick the FBC log-prob path once
+        if self.discrete:
+            self._logp_fn = self._logp_discrete
+        elif self.multibinary:
+            self._logp_fn = self._logp_multibinary
+        else:
+            self._logp_fn = self._logp_continuous
 
         self.reward_multiplier = reward_multiplier
         self.pad_val = MAGIC_PAD_VAL
@@ -105,6 +200,8 @@ class Agent(nn.Module):
         self.max_seq_len = max_seq_len
         self.batch_size = batch_size
         self._critic_loss_weight = critic_loss_weight
+        assert mixed_precision in ["no", "bf16"]
+        self.mixed_precision = mixed_precision
 
         self.tstep_encoder = tstep_encoder_Cls(
             obs_space=obs_space,
@@ -129,10 +226,36 @@ class Agent(nn.Module):
         # provided hparam `gamma` will stay in the -1 index
         # of gammas, actor, and critic outputs.
         gammas = (multigammas if use_multigamma else []) + [gamma]
-        self.gammas = torch.Tensor(gammas).float()
+        # non-persistent buffers follow the agent's device without changing its state_dict
+        self.register_buffer(
+            "gammas", torch.tensor(gammas, dtype=torch.float32, device=device), persistent=False
+        )
+        # pre-shaped to broadcast against (B, L, C, G, 1) TD target arrays
+        self.register_buffer("_gammas_bcast", self.gammas.view(1, 1, 1, -1, 1), persistent=False)
         assert num_critics_td <= num_critics
         self.num_critics = num_critics
         self.num_critics_td = num_critics_td
+        # static shape constants for the training step
+        self._C = num_critics
+        self._G = len(gammas)
+        # fuse the TD target's chain of pointwise ops into one kernel on GPU
+        self.compile_td_target = compile_td_target and torch.device(device).type == "cuda"
+        self._td_target_fn = self._maybe_compile(redq_td_target)
+        # bf16 halves the traffic of the (B, L, C, G, 1) ensemble targets, but at ~3
+        # significant digits, so it is opt-in. PopArt and the labels always see fp32.
+        self._td_dtype = torch.bfloat16 if bf16_td_target else torch.float32
+        # the no-grad TD target block can overlap the online critic passes
+        if td_target_stream and torch.device(device).type == "cuda":
+            self._side_stream = torch.cuda.Stream(device=torch.device(device))
+        else:
+            self._side_stream = None
+
+        # "reduce-overhead" captures CUDA graphs of the fixed-shape rollout pieces
+        self._graphed_rollouts = cuda_graph_rollouts and torch.device(device).type == "cuda"
+        if self._graphed_rollouts:
+            graph = lambda fn: torch.compile(fn, mode="reduce-overhead", dynamic=False)
+            self._rollout_tstep_fn = graph(self._rollout_tstep)
+            self._rollout_actor_fn = graph(self._rollout_actor)
 
         self.popart = actor_critic.PopArtLayer(gammas=len(gammas), enabled=popart, device=device).to(device)
 
@@ -146,18 +269,18 @@ class Agent(nn.Module):
         self.target_critics = actor_critic.NCritics(
             **ac_kwargs, num_critics=num_critics
         ).to(device)
-        self.maximized_critics = actor_critic.NCritics(
-            **ac_kwargs, num_critics=num_critics
-        ).to(device)
         if self.multibinary:
             ac_kwargs["cont_dist_kind"] = "multibinary"
         self.actor = actor_critic.Actor(**ac_kwargs).to(device)
         self.target_actor = actor_critic.Actor(**ac_kwargs).to(device)
         # full weight copy to targets
         self.hard_sync_targets()
+        # old checkpoints still load with strict=True
+        self._register_load_state_dict_pre_hook(drop_maximized_critics_keys)
 
         # optimizer
-        self.optimizer = torch.optim.AdamW(
+        self._trainable_params = None
+        self.optimizer = utils.get_adamw(
             self.trainable_params,
             lr=learning_rate,
             weight_decay=l2_coeff,
@@ -165,6 +288,14 @@ class Agent(nn.Module):
         self.lr_schedule = utils.get_constant_schedule_with_warmup(
             optimizer=self.optimizer, num_warmup_steps=lr_warmup_steps
         )
+        # (state_mask, actor_mask, critic_mask) of the most recent forward pass
+        self._cached_masks = None
+        # pinned host staging area for rollout actions (see `get_actions`)
+        self._action_host = None
+        # reusable (1, 1, ...) staging arrays for `add_data_to_sequence_buffer`.
+        # rl2 layout is (reset, reward, time, action)
+        self._rl2_stage = np.zeros((1, 1, 3 + self.action_dim), dtype=np.float32)
+        self._goal_stage = np.zeros((1, 1, 1, 1), dtype=np.float32)
 
     def update(self, batch: AmagoBatch, **kwargs) -> dict:
         """
@@ -179,14 +310,65 @@ class Agent(nn.Module):
         """
 
         self.optimizer.zero_grad()
-        loss_dict = self._compute_loss(batch)
-        loss = loss_dict["actor_loss"] + self._critic_loss_weight * loss_dict["critic_loss"]
+        self._cached_masks = None
+        # params (and AdamW state) stay fp32; only the forward pass is cast
+        with self.caster():
+            loss_dict = self._compute_loss(batch)
+            loss = loss_dict["actor_loss"] + self._critic_loss_weight * loss_dict["critic_loss"]
         loss.backward()
         self.optimizer.step()
         self.lr_schedule.step()
 
         return loss_dict
 
+    def caster(self):
+        """
+        bf16 autocast on cuda when `mixed_precision == "bf16"` and the device supports
+        it. Also wraps the no-grad critic passes (target critics, FBC value estimate),
+        so those follow the same setting.
+        """
+        if (
+            self.mixed_precision == "bf16"
+            and torch.device(self.device).type == "cuda"
+            and torch.cuda.is_bf16_supported()
+        ):
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        else:
+            return contextlib.suppress()
+
+    def _maybe_compile(self, fn):
+        # (C, G, Bins) are fixed for a run, but the padded sequence length L changes
+        # from batch to batch: let dynamo mark the varying dims dynamic
+        if self.compile_td_target:
+            return torch.compile(fn, dynamic=None)
+        return fn
+
+    def _state_mask(self, batch) -> torch.Tensor:
+        # (B, L, 1) float mask of timesteps that are not padding. Our collate fn
+        # precomputes it; fall back to checking the rl2s for other batch types
+        pad_mask = getattr(batch, "pad_mask", None)
+        if pad_mask is not None:
+            return pad_mask
+        return (~((batch.rl2s == self.pad_val).all(-1, keepdim=True))).float()
+
+    def _td_target_stream(self):
+        # side stream context for the TD target block (a no-op off cuda)
+        if self._side_stream is None:
+            return contextlib.suppress()
+        # wait for s_rep and the target actor's outputs
+        self._side_stream.wait_stream(torch.cuda.current_stream())
+        return torch.cuda.stream(self._side_stream)
+
+    def _join_td_target_stream(self, *tensors: torch.Tensor):
+        # make the main stream wait on the TD target block before consuming its outputs
+        if self._side_stream is None:
+            return
+        main_stream = torch.cuda.current_stream()
+        main_stream.wait_stream(self._side_stream)
+        for t in tensors:
+            # allocated on the side stream, freed after use on the main stream
+            t.record_stream(main_stream)
+
     def _compute_loss(self, batch: AmagoBatch):
         """
         Compute the Amago loss. Mimics the "compute_loss" function from
@@ -201,11 +383,9 @@ class Agent(nn.Module):
         critic_loss, actor_loss = self.forward(batch, True)
 
         update_info = self.update_info
-        B, L_1, G, _ = actor_loss.shape
-        C = len(self.critics)
-        state_mask = (~((batch.rl2s == MAGIC_PAD_VAL).all(-1, keepdim=True))).float()
-        critic_state_mask = repeat(state_mask[:, 1:, ...], f"B L 1 -> B L {C} {G} 1")
-        actor_state_mask = repeat(state_mask[:, :-1, ...], f"B L 1 -> B L {G} 1")
+        # padding masks were already built during the forward pass
+        state_mask, actor_mask, critic_state_mask = self._cached_masks
+        actor_state_mask = actor_mask[:, :-1, ...]
 
         masked_actor_loss = utils.masked_avg(actor_loss, actor_state_mask)
         if isinstance(critic_loss, torch.Tensor):
@@ -227,11 +407,12 @@ class Agent(nn.Module):
         dict_based = isinstance(sequences, dict)
         if not dict_based:
             sequences = {"dummy": sequences}
+        # one (B, 1) index shared by every sequence, whatever its trailing dims
+        idx = seq_lengths.reshape(-1, 1) - 1
         timesteps = {}
         for k, v in sequences.items():
-            missing_dims = v.ndim - seq_lengths.ndim
-            seq_lengths_ = seq_lengths.reshape(seq_lengths.shape + (1,) * missing_dims)
-            timesteps[k] = torch.take_along_dim(v, seq_lengths_ - 1, dim=1)
+            idx_ = idx.view(idx.shape + (1,) * (v.ndim - 2))
+            timesteps[k] = torch.take_along_dim(v, idx_, dim=1)
         if not dict_based:
             timesteps = timesteps["dummy"]
         return timesteps
@@ -239,24 +420,39 @@ class Agent(nn.Module):
     @property
     def trainable_params(self):
         """
-        Returns iterable of all trainable parameters that should be passed to an optimzer. (Everything but the target networks).
+        Returns list of all trainable parameters that should be passed to an optimzer. (Everything but the target networks).
         """
-        return chain(
-            self.tstep_encoder.parameters(),
-            self.traj_encoder.parameters(),
-            self.critics.parameters(),
-            self.actor.parameters(),
-        )
+        # cached so repeated access (optimizers, grad clipping) skips the module walk
+        if self._trainable_params is None:
+            self._trainable_params = list(
+                chain(
+                    self.tstep_encoder.parameters(),
+                    self.traj_encoder.parameters(),
+                    self.critics.parameters(),
+                    self.actor.parameters(),
+                )
+            )
+        return self._trainable_params
 
+    @torch.no_grad()
     def _full_copy(self, target, online):
-        for target_param, param in zip(target.parameters(), online.parameters()):
-            target_param.data.copy_(param.data)
+        # multi-tensor kernels instead of one launch per parameter
+        target_params, online_params = list(target.parameters()), list(online.parameters())
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(target_params, online_params)
+        else:
+            for target_param, param in zip(target_params, online_params):
+                target_param.copy_(param)
 
+    @torch.no_grad()
     def _ema_copy(self, target, online):
-        for target_param, param in zip(target.parameters(), online.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.tau) + param.data * self.tau
-            )
+        # target + tau * (online - target)
+        target_params, online_params = list(target.parameters()), list(online.parameters())
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(target_params, online_params, self.tau)
+        else:
+            for target_param, param in zip(target_params, online_params):
+                target_param.lerp_(param, self.tau)
 
     def hard_sync_targets(self):
         """
@@ -264,7 +460,6 @@ class Agent(nn.Module):
         """
         self._full_copy(self.target_critics, self.critics)
         self._full_copy(self.target_actor, self.actor)
-        self._full_copy(self.maximized_critics, self.critics)
 
     def soft_sync_targets(self):
         """
@@ -272,8 +467,14 @@ class Agent(nn.Module):
         """
         self._ema_copy(self.target_critics, self.critics)
         self._ema_copy(self.target_actor, self.actor)
-        # full copy duplicate critic
-        self._full_copy(self.maximized_critics, self.critics)
+
+    def maximized_critics(self, state, action, **kwargs):
+        """
+        Evaluate the online critics without letting gradients reach their parameters.
+        The actor maximizes this output, so grads should only flow through `action`.
+        """
+        params = {k: v.detach() for k, v in self.critics.named_parameters()}
+        return torch.func.functional_call(self.critics, params, (state, action), kwargs)
 
     def get_actions(
         self,
@@ -291,10 +492,18 @@ class Agent(nn.Module):
         using_hidden = hidden_state is not None
         if using_hidden:
             obs = self.get_current_timestep(obs, seq_lengths)
-            goals = self.get_current_timestep(goals, seq_lengths)
-            rl2s = self.get_current_timestep(rl2s, seq_lengths)
-            time_idxs = self.get_current_timestep(time_idxs, seq_lengths.squeeze(-1))
-        tstep_emb = self.tstep_encoder(obs=obs, goals=goals, rl2s=rl2s)
+            current = self.get_current_timestep(
+                {"goals": goals, "rl2s": rl2s, "time_idxs": time_idxs}, seq_lengths
+            )
+            goals, rl2s, time_idxs = current["goals"], current["rl2s"], current["time_idxs"]
+        # with a hidden state every input is (parallel_actors, 1, ...), so the
+        # timestep encoder and actor head can replay CUDA graphs
+        graphed = self._graphed_rollouts and using_hidden
+        if graphed:
+            # (cloned: graph outputs are overwritten by the next replay)
+            tstep_emb = self._rollout_tstep_fn(obs, goals, rl2s).clone()
+        else:
+            tstep_emb = self.tstep_encoder(obs=obs, goals=goals, rl2s=rl2s)
 
         # sequence model embedding [batch, length, d_emb]
         traj_emb_t, hidden_state = self.traj_encoder(
@@ -303,8 +512,33 @@ class Agent(nn.Module):
         if not using_hidden:
             traj_emb_t = self.get_current_timestep(traj_emb_t, seq_lengths)
 
+        rollout_actor = self._rollout_actor_fn if graphed else self._rollout_actor
+        actions = rollout_actor(traj_emb_t.squeeze(1), sample)
+        if actions.is_cuda:
+            # D2H copy into a persistent pinned buffer. the envs need the
+            # values right away, so we only wait on the copy itself.
+            if self._action_host is None or self._action_host.shape != actions.shape:
+                self._action_host = torch.empty(actions.shape, dtype=torch.float32, pin_memory=True)
+                self._action_copied = torch.cuda.Event()
+            self._action_host.copy_(actions, non_blocking=True)
+            self._action_copied.record()
+            self._action_copied.synchronize()
+            actions = self._action_host.numpy()
+        else:
+            actions = actions.cpu().float().numpy()
+        # (astype copies out of the reused staging buffer)
+        if self.discrete:
+            actions = actions.astype(np.uint8)
+        else:
+            actions = actions.astype(np.float32)
+        return actions, hidden_state
+
+    def _rollout_tstep(self, obs, goals, rl2s):
+        return self.tstep_encoder(obs=obs, goals=goals, rl2s=rl2s)
+
+    def _rollout_actor(self, traj_emb_t, sample: bool):
         # generate action distribution [batch, len(self.gammas), d_action]
-        action_dists = self.actor(traj_emb_t.squeeze(1))
+        action_dists = self.actor(traj_emb_t)
         if sample:
             actions = action_dists.sample()
         else:
@@ -312,14 +546,8 @@ class Agent(nn.Module):
                 actions = torch.argmax(action_dists.probs, dim=-1, keepdim=True)
             else:
                 actions = action_dists.mean
-
         # get intended gamma distribution (always in -1 idx)
-        actions = actions[..., -1, :].cpu().float().numpy()
-        if self.discrete:
-            actions = actions.astype(np.uint8)
-        else:
-            actions = actions.astype(np.float32)
-        return actions, hidden_state
+        return actions[..., -1, :].detach()
 
     def forward(self, batch: Union[Batch, AmagoBatch], log_step: bool):
         """
@@ -346,21 +574,24 @@ class Agent(nn.Module):
         a = a.clamp(0, 1.0) if self.discrete else a.clamp(-1., 1.)
         _B, _L, D_action = a.shape
         assert _L == L - 1
-        G = len(self.gammas)
+        G = self._G
         # note that the last timestep does not have an action.
         # we give it a fake one to make shape math work.
         a_buffer = torch.cat((a, a[:, -1, ...].clone().unsqueeze(1)), axis=1)
-        a_buffer = repeat(a_buffer, f"b l a -> b l {G} a")
-        C = len(self.critics)
+        # broadcast views (no copies) over the gamma/critic dims
+        a_buffer = a_buffer.unsqueeze(2).expand(-1, -1, G, -1)
+        C = self._C
         # arrays used by critic update end up in a (B, L, C, G, dim) format
         assert batch.rews.shape == (B, L - 1, 1)
         assert batch.dones.shape == (B, L - 1, 1)
-        r = repeat((self.reward_multiplier * batch.rews).float(), f"b l r -> b l 1 {G} r")
-        d = repeat(batch.dones.float(), f"b l d -> b l 1 {G} d")
+        # (scaling by the python float multiplier already promotes to float)
+        r = (self.reward_multiplier * batch.rews)[:, :, None, None, :].expand(-1, -1, 1, G, -1)
+        d = batch.dones.float()[:, :, None, None, :].expand(-1, -1, 1, G, -1)
         D_emb = self.traj_encoder.emb_dim
-        state_mask = (~((batch.rl2s == self.pad_val).all(-1, keepdim=True))).float()
-        actor_mask = repeat(state_mask, f"b l 1 -> b l {G} 1")
-        critic_mask = repeat(state_mask[:, 1:, ...], f"b l 1 -> b l {C} {G} 1")
+        state_mask = self._state_mask(batch)
+        actor_mask = state_mask.unsqueeze(2).expand(-1, -1, G, -1)
+        critic_mask = state_mask[:, 1:, None, None, :].expand(-1, -1, C, G, -1)
+        self._cached_masks = (state_mask, actor_mask, critic_mask)
 
         ################################
         ## Step 2: Sequence Embedding ##
@@ -373,8 +604,14 @@ class Agent(nn.Module):
         ## Step 3: a' ~ \pi, Q(s, a'), Q(s, a) ##
         #########################################
         critic_loss = None
+        needs_td_target = not self.fake_filter or self.online_coeff > 0
         # one actor forward pass
         a_dist = self.actor(s_rep)
+        if needs_td_target and self.use_target_actor:
+            with torch.no_grad():
+                a_prime_dist = self.target_actor(s_rep)
+        else:
+            a_prime_dist = a_dist
 
         if self.discrete:
             a_agent = a_dist.probs
@@ -383,49 +620,54 @@ class Agent(nn.Module):
         else:
             a_agent = a_dist.sample()
 
-        if not self.fake_filter or self.online_coeff > 0:
-            s_a_agent_g = (s_rep.detach(), a_agent)
-            # detach() above b/c these grads flow to traj_encoder through the policy
-            s_a_g = (s_rep[:, :-1, ...], a_buffer[:, :-1, ...])
-            # all the `phi` terms are only here b/c we used to implement DR3
-            q_s_a_agent_g, phi_s_a_agent_g = self.maximized_critics(*s_a_agent_g)
-            assert q_s_a_agent_g.shape == (B, L, C, G, 1)
-            q_s_a_g, phi_s_a_g = self.critics(*s_a_g)
-
+        if needs_td_target:
             ########################
             ## Step 4: TD Targets ##
             ########################
             # \mathcal{B}\bar{Q}(s, a, g)
-            with torch.no_grad():
-                a_prime_dist = self.target_actor(s_rep) if self.use_target_actor else a_dist
+            # issued first so that it can run on a side stream while the online
+            # critic passes below run on the main stream
+            with torch.no_grad(), self._td_target_stream():
                 ap = a_prime_dist.probs if self.discrete else a_prime_dist.sample()
                 assert ap.shape == (B, L, G, D_action)
                 sp_ap_gp = (s_rep[:, 1:, ...].detach(), ap[:, 1:, ...].detach())
-                q_targ_sp_ap_gp, _ = self.target_critics(*sp_ap_gp)
+                # target critics are inference-only: with mixed precision on,
+                # run their matmuls in bf16
+                with self.caster():
+                    q_targ_sp_ap_gp, _ = self.target_critics(*sp_ap_gp)
+                q_targ_sp_ap_gp = q_targ_sp_ap_gp.float()
                 assert q_targ_sp_ap_gp.shape == (B, L - 1, C, G, 1)
                 q_targ_sp_ap_gp = self.popart(q_targ_sp_ap_gp, normalized=False)
                 assert q_targ_sp_ap_gp.shape == (B, L - 1, C, G, 1)
-                gamma = self.gammas.to(r.device).unsqueeze(-1)
-                ensemble_td_target = r + gamma * (1.0 - d) * q_targ_sp_ap_gp
-                assert ensemble_td_target.shape == (B, L - 1, C, G, 1)
-                # redq random subset of critic ensemble. multigamma format
-                # makes this even more random.
-                random_subset = torch.randint(
-                    low=0,
-                    high=C,
-                    size=(B, L - 1, self.num_critics_td, G, 1),
-                    device=r.device,
+                gamma = self._gammas_bcast
+                # redq random subset of critic ensemble, shared across gammas
+                random_subset = redq_random_subset(
+                    B, L - 1, C, self.num_critics_td, device=r.device
                 )
-                td_target_rand = torch.take_along_dim(
-                    ensemble_td_target, random_subset, dim=2
+                # clipped double q. without DPG updates the usual min creates
+                # strong underestimation, so take the mean instead
+                td_target = self._td_target_fn(
+                    r,
+                    d,
+                    gamma,
+                    q_targ_sp_ap_gp,
+                    random_subset,
+                    clipped=self.online_coeff > 0,
+                    dtype=self._td_dtype,
                 )
-                if self.online_coeff > 0:
-                    # clipped double q
-                    td_target = td_target_rand.min(2, keepdims=True).values
-                else:
-                    # without DPG updates the usual min creates strong underestimation. take mean instead
-                    td_target = td_target_rand.mean(2, keepdims=True)
                 assert td_target.shape == (B, L - 1, 1, G, 1)
+
+            s_a_agent_g = (s_rep.detach(), a_agent)
+            # detach() above b/c these grads flow to traj_encoder through the policy
+            s_a_g = (s_rep[:, :-1, ...], a_buffer[:, :-1, ...])
+            # all the `phi` terms are only here b/c we used to implement DR3
+            q_s_a_agent_g, phi_s_a_agent_g = self.maximized_critics(*s_a_agent_g)
+            assert q_s_a_agent_g.shape == (B, L, C, G, 1)
+            q_s_a_g, phi_s_a_g = self.critics(*s_a_g)
+
+            # popart's buffers are only written on the main stream
+            self._join_td_target_stream(td_target)
+            with torch.no_grad():
                 self.popart.update_stats(
                     td_target, mask=critic_mask.all(2, keepdim=True)
                 )
@@ -436,13 +678,15 @@ class Agent(nn.Module):
             ## Step 5: Critic Loss ##
             #########################
             assert q_s_a_g.shape == (B, L - 1, C, G, 1)
-            critic_loss = (self.popart(q_s_a_g) - td_target_norm.detach()).pow(2)
+            q_s_a_g_norm = self.popart(q_s_a_g)
+            critic_loss = (q_s_a_g_norm - td_target_norm.detach()).pow(2)
             assert critic_loss.shape == (B, L - 1, C, G, 1)
             if log_step:
                 td_stats = self._td_stats(
                     critic_mask,
                     q_s_a_g,
-                    self.popart(q_s_a_g, normalized=False),
+                    # same as self.popart(q_s_a_g, normalized=False)
+                    self.popart.denormalize_values(q_s_a_g_norm),
                     r,
                     td_target,
                 )
@@ -452,7 +696,8 @@ class Agent(nn.Module):
         ######################
         ## Step 6: DPG Loss ##
         ######################
-        actor_loss = torch.zeros((B, L - 1, G, 1), device=a.device)
+        # loss terms are summed lazily; only allocate zeros if none are active
+        actor_loss = 0.0
         if self.online_coeff > 0:
             assert (
                 self.actor.actions_differentiable
@@ -472,76 +717,105 @@ class Agent(nn.Module):
                 with torch.no_grad():
                     val_s_g = q_s_a_agent_g[:, :-1, ...].mean(2).detach()
                     assert val_s_g.shape == (B, L - 1, G, 1)
-                    advantage_a_s_g = q_s_a_g.mean(2) - val_s_g
+                    advantage_a_s_g = q_s_a_g.mean(2).sub_(val_s_g)
                     assert advantage_a_s_g.shape == (B, L - 1, G, 1)
                     filter_ = (advantage_a_s_g > 1e-3).float()
             else:
-                # Behavior Cloning
-                filter_ = torch.ones((1, 1, 1, 1), device=a.device)
-            if self.discrete:
-                # buffer actions are one-hot encoded
-                logp_a = a_dist.log_prob(a_buffer.argmax(-1)).unsqueeze(-1)
-            elif self.multibinary:
-                logp_a = a_dist.log_prob(a_buffer).mean(-1, keepdim=True)
-            else:
-                # action probs at the [-1, 1] border can be unstable
-                logp_a = a_dist.log_prob(a_buffer.clamp(-0.995, 0.995)).sum(-1, keepdim=True)
+                # Behavior Cloning (no filter to multiply by)
+                filter_ = None
+            logp_a = self._logp_fn(a_dist, a_buffer)
             # clamp for stability and throw away last action that was a duplicate
             logp_a = logp_a[:, :-1, ...].clamp(-1e3, 1e3)
             # filtered nll
-            actor_loss += self.offline_coeff * -(filter_.detach() * logp_a)
+            actor_loss += self.offline_coeff * -filtered(filter_, logp_a)
             if log_step:
                 filter_stats = self._filter_stats(actor_mask, logp_a, filter_)
                 self.update_info.update(filter_stats)
 
+        if not isinstance(actor_loss, torch.Tensor):
+            actor_loss = s_rep.new_zeros((B, L - 1, G, 1))
         # fmt: on
         return critic_loss, actor_loss
 
-    def _td_stats(self, mask, raw_q_s_a_g, q_s_a_g, r, td_target) -> dict:
-        # messy data gathering for wandb console
-        def masked_avg(x_, dim=0):
-            return (mask[..., dim, :] * x_[..., dim, :]).sum().detach() / mask[
-                ..., dim, :
-            ].sum()
+    @staticmethod
+    def _logp_discrete(a_dist, a_buffer):
+        # buffer actions are one-hot encoded
+        return a_dist.log_prob(a_buffer.argmax(-1)).unsqueeze(-1)
+
+    @staticmethod
+    def _logp_multibinary(a_dist, a_buffer):
+        return a_dist.log_prob(a_buffer).mean(-1, keepdim=True)
 
+    @staticmethod
+    def _logp_continuous(a_dist, a_buffer):
+        if isinstance(a_dist, actor_critic._SquashedNormal):
+            # fused clamp/atanh/log_prob/sum; clips inside the (tighter) tanh bounds
+            return a_dist.summed_log_prob(a_buffer)
+        # action probs at the [-1, 1] border can be unstable
+        return a_dist.log_prob(a_buffer.clamp(-0.995, 0.995)).sum(-1, keepdim=True)
+
+    def _td_stats(self, mask, raw_q_s_a_g, q_s_a_g, r, td_target) -> dict:
+        # messy data gathering for wandb console.
+        # each stat family is reduced over all gammas in one pass
+        raw_q_avg = masked_avg_per_gamma(raw_q_s_a_g, mask)
+        if q_s_a_g is not None:
+            q_avg = masked_avg_per_gamma(q_s_a_g, mask)
+            q_std = q_s_a_g.std()
+        else:
+            # popart is a per-gamma affine map, so the rescaled stats can be
+            # recovered from reductions of the raw values
+            q_avg, q_std = self._popart_rescaled_stats(raw_q_s_a_g, raw_q_avg)
+        raw_q_ensemble_std = raw_q_s_a_g.std(2).mean((0, 1, 3))
+        # masked min/max via fills: masked_select would need a nonzero (and a sync)
+        td_target_mask = mask.all(2, keepdims=True).bool()
+        min_td_target = td_target.masked_fill(~td_target_mask, float("inf")).min()
+        max_td_target = td_target.masked_fill(~td_target_mask, float("-inf")).max()
+        # reverse cumsum over time (sum_{t' >= t} r_t') without two flip copies
+        masked_r = mask.all(2, keepdims=True) * r
+        real_return = masked_r.sum(1, keepdim=True) - masked_r.cumsum(1) + masked_r
         stats = {}
-        for i, gamma in enumerate(self.gammas):
-            stats[f"Q(s, a) (global mean, rescaled) gamma={gamma:.3f}"] = masked_avg(
-                q_s_a_g, i
-            )
-            stats[f"Q(s,a) (global mean, raw scale) gamma={gamma:.3f}"] = masked_avg(
-                raw_q_s_a_g, i
-            )
+        for i, gamma in enumerate(self.gammas.tolist()):
+            stats[f"Q(s, a) (global mean, rescaled) gamma={gamma:.3f}"] = q_avg[i]
+            stats[f"Q(s,a) (global mean, raw scale) gamma={gamma:.3f}"] = raw_q_avg[i]
             stats[
                 f"Q(s, a) Ensemble Stdev. (raw scale, ignoring padding) gamma={gamma:.3f}"
-            ] = (raw_q_s_a_g[..., i, :].std(2).mean())
+            ] = raw_q_ensemble_std[i]
 
         stats.update(
             {
-                "Q(s, a) (global std, rescaled, ignoring padding)": q_s_a_g.std(),
-                "Min TD Target": td_target[
-                    torch.where(mask.all(2, keepdims=True) > 0)
-                ].min(),
-                "Max TD Target": td_target[
-                    torch.where(mask.all(2, keepdims=True) > 0)
-                ].max(),
-                "TD Target (test-time gamma)": masked_avg(td_target, -1),
-                "Mean Reward (in training sequences)": masked_avg(r),
-                "real_return": torch.flip(
-                    torch.cumsum(torch.flip(mask.all(2, keepdims=True) * r, (1,)), 1),
-                    (1,),
-                ).squeeze(-1),
+                "Q(s, a) (global std, rescaled, ignoring padding)": q_std,
+                "Min TD Target": min_td_target,
+                "Max TD Target": max_td_target,
+                "TD Target (test-time gamma)": masked_avg_per_gamma(td_target, mask)[-1],
+                "Mean Reward (in training sequences)": masked_avg_per_gamma(r, mask)[0],
+                "real_return": real_return.squeeze(-1),
             }
         )
         return stats
 
+    def _popart_rescaled_stats(self, raw_q_s_a_g, raw_q_avg):
+        """
+        Masked per-gamma mean and (unmasked) global std of
+        `popart.normalize_values(raw_q_s_a_g)`, without normalizing the full tensor.
+        """
+        normalize = lambda x: self.popart.normalize_values(x.unsqueeze(-1)).squeeze(-1)
+        scale = self.popart.sigma.squeeze(-1) if self.popart.enabled else 1.0
+        q_avg = normalize(raw_q_avg)
+        # per-gamma moments of the normalized values (equal counts per gamma)
+        dims = tuple(range(raw_q_s_a_g.ndim - 2))
+        raw_var, raw_mean = torch.var_mean(
+            raw_q_s_a_g.squeeze(-1), dim=dims, correction=0
+        )
+        z_mean = normalize(raw_mean)
+        z_sq_mean = raw_var / scale**2 + z_mean**2
+        n = raw_q_s_a_g.numel()
+        q_var = (z_sq_mean.mean() - z_mean.mean() ** 2) * n / (n - 1)
+        return q_avg, q_var.clamp(min=0).sqrt()
+
     def _policy_stats(self, mask, a_dist) -> dict:
         # messy data gathering for wandb console
         # mask shape is batch length gammas 1
-        sum_ = mask.sum((0, 1))
-        masked_avg = (
-            lambda x_, dim: (mask[..., dim, :] * x_[..., dim, :]).sum().detach() / sum_
-        )
+        masked_avg = lambda x_, dim: masked_avg_per_gamma(x_, mask)[dim]
 
         if self.discrete:
             entropy = a_dist.entropy().unsqueeze(-1)
@@ -566,37 +840,36 @@ class Agent(nn.Module):
     def _filter_stats(self, mask, logp_a, filter_) -> dict:
         mask = mask[:, :-1, ...]
 
-        # messy data gathering for wandb console
-        def masked_avg(x_, dim=0):
-            return (mask[..., dim, :] * x_[..., dim, :]).sum().detach() / mask[
-                ..., dim, :
-            ].sum()
-
         # messy data gathering for wandb console
         stats = {
             "Minimum Action Logprob": logp_a.min(),
             "Maximum Action Logprob": logp_a.max(),
-            "Pct. of Actions Approved by Binary FBC Filter (All Gammas)": utils.masked_avg(
-                filter_, mask
-            )
-            * 100.0,
         }
+        if filter_ is None:
+            # behavior cloning approves every action
+            stats["Pct. of Actions Approved by Binary FBC Filter (All Gammas)"] = 100.0
+            return stats
+        stats["Pct. of Actions Approved by Binary FBC Filter (All Gammas)"] = (
+            utils.masked_avg(filter_, mask) * 100.0
+        )
 
-        if filter_.shape[-2] == len(self.gammas):
-            for i, gamma in enumerate(self.gammas):
+        if filter_.shape[-2] == self._G:
+            pct_approved = masked_avg_per_gamma(filter_, mask) * 100.0
+            for i, gamma in enumerate(self.gammas.tolist()):
                 stats[
                     f"Pct. of Actions Approved by Binary FBC (gamma = {gamma : .3f})"
-                ] = (masked_avg(filter_, dim=i) * 100.0)
+                ] = pct_approved[i]
         return stats
 
     def _popart_stats(self) -> dict:
-        # messy data gathering for wandb console
+        # messy data gathering for wandb console.
+        # left on device so they join the logger's single transfer to the cpu
         return {
-            "PopArt mu (mean over gamma)": self.popart.mu.data.mean().item(),
-            "PopArt nu (mean over gamma)": self.popart.nu.data.mean().item(),
-            "PopArt w (mean over gamma)": self.popart.w.data.mean().item(),
-            "PopArt b (mean over gamma)": self.popart.b.data.mean().item(),
-            "PopArt sigma (mean over gamma)": self.popart.sigma.mean().item(),
+            "PopArt mu (mean over gamma)": self.popart.mu.data.mean(),
+            "PopArt nu (mean over gamma)": self.popart.nu.data.mean(),
+            "PopArt w (mean over gamma)": self.popart.w.data.mean(),
+            "PopArt b (mean over gamma)": self.popart.b.data.mean(),
+            "PopArt sigma (mean over gamma)": self.popart.sigma.mean(),
         }
 
     def add_data_to_sequence_buffer(
@@ -618,24 +891,24 @@ class Agent(nn.Module):
             "observation": np.expand_dims(obs.astype(np.float32), axis=(0, 1))
         }
         _done = np.expand_dims(done, axis=(0, 1))
-        _goal = np.expand_dims(np.array([0.], dtype=np.float32), axis=(0, 1, 2))
-        _time = np.expand_dims(np.array([time_step / 1000], dtype=np.float32), axis=(0, 1))
 
+        # write in place instead of building and concatenating tiny arrays.
+        # (`add_timestep` copies to the device, so reusing the stage is safe)
+        _rl2 = self._rl2_stage
+        _rl2[0, 0, 2] = time_step / 1000
         # first timestep requires some dummy variables
         if time_step == 0:
-            _action = np.expand_dims(np.array([-2] * self.action_dim, dtype=np.float32), axis=(0, 1))  # -2 for dummy action, 0
-            _reset = np.expand_dims(np.array([1.], dtype=np.float32), axis=(0, 1))
-            _reward = np.expand_dims(np.array([0.], dtype=np.float32), axis=(0, 1))
+            _rl2[0, 0, 0] = 1.0
+            _rl2[0, 0, 1] = 0.0
+            _rl2[0, 0, 3:] = -2  # -2 for dummy action
         else:
-            _action = np.expand_dims(action, axis=(0))
-            _reset = np.expand_dims(np.array([0.], dtype=np.float32), axis=(0, 1))
-            _reward = np.expand_dims([reward], axis=(0, 1))
-
-        _rl2 = np.concatenate((_reset, _reward, _time, _action), axis=-1, dtype=np.float32)
+            _rl2[0, 0, 0] = 0.0
+            _rl2[0, 0, 1] = reward
+            _rl2[0, 0, 3:] = np.reshape(action, -1)
 
         # add to sequence buffers
         obs_sequence.add_timestep(_obs, _done)
-        goal_sequence.add_timestep(_goal, _done)
+        goal_sequence.add_timestep(self._goal_stage, _done)
         rl2_sequence.add_timestep(_rl2, _done)
 
         return obs_sequence, goal_sequence, rl2_sequence
@@ -682,6 +955,9 @@ class MultiTaskAgent(Agent):
         )
         self.fbc_filter_k = fbc_filter_k
         self.fbc_filter_func = fbc_filter_func
+        if self.discrete:
+            # `DiscreteLikeContinuous` handles the one-hot actions itself
+            self._logp_fn = lambda a_dist, a_buffer: a_dist.log_prob(a_buffer)
 
         critic_kwargs = {
             "state_dim": self.traj_encoder.emb_dim,
@@ -691,7 +967,10 @@ class MultiTaskAgent(Agent):
         }
         self.critics = actor_critic.NCriticsTwoHot(**critic_kwargs)
         self.target_critics = actor_critic.NCriticsTwoHot(**critic_kwargs)
-        self.maximized_critics = actor_critic.NCriticsTwoHot(**critic_kwargs)
+        # the cached parameter list still points to the replaced critics
+        self._trainable_params = None
+        self._two_hot_td_target_fn = self._maybe_compile(two_hot_td_target)
+        self._two_hot_loss_fn = self._maybe_compile(two_hot_cross_entropy)
         self.hard_sync_targets()
 
     def forward(self, batch: Batch, log_step: bool):
@@ -714,21 +993,22 @@ class MultiTaskAgent(Agent):
         a = a.clamp(0, 1.0) if self.discrete else a.clamp(-1.0, 1.0)
         _B, _L, D_action = a.shape
         assert _L == L - 1
-        G = len(self.gammas)
+        G = self._G
         a_buffer = torch.cat((a, a[:, -1, ...].clone().unsqueeze(1)), axis=1)
-        a_buffer = repeat(a_buffer, f"b l a -> b l {G} a")
-        C = len(self.critics)
+        a_buffer = a_buffer.unsqueeze(2).expand(-1, -1, G, -1)
+        C = self._C
         assert batch.rews.shape == (B, L - 1, 1)
         assert batch.dones.shape == (B, L - 1, 1)
-        r = repeat(
-            (self.reward_multiplier * batch.rews).float(), f"b l r -> b l 1 {G} r"
+        r = (self.reward_multiplier * batch.rews)[:, :, None, None, :].expand(
+            -1, -1, 1, G, -1
         )
-        d = repeat(batch.dones.float(), f"b l d -> b l 1 {G} d")
+        d = batch.dones.float()[:, :, None, None, :].expand(-1, -1, 1, G, -1)
         D_emb = self.traj_encoder.emb_dim
         Bins = self.critics.num_bins
-        state_mask = (~((batch.rl2s == self.pad_val).all(-1, keepdim=True))).float()
-        actor_mask = repeat(state_mask, f"b l 1 -> b l {G} 1")
-        critic_mask = repeat(state_mask[:, 1:, ...], f"b l 1 -> b l {C} {G} 1")
+        state_mask = self._state_mask(batch)
+        actor_mask = state_mask.unsqueeze(2).expand(-1, -1, G, -1)
+        critic_mask = state_mask[:, 1:, None, None, :].expand(-1, -1, C, G, -1)
+        self._cached_masks = (state_mask, actor_mask, critic_mask)
 
         ################################
         ## Step 2: Sequence Embedding ##
@@ -741,56 +1021,47 @@ class MultiTaskAgent(Agent):
         #########################################
         ## Step 3: a' ~ \pi, Q(s, a'), Q(s, a) ##
         #########################################
+        needs_td_target = not self.fake_filter or self.online_coeff > 0
         a_dist = self.actor(s_rep)
+        if needs_td_target and self.use_target_actor:
+            with torch.no_grad():
+                a_prime_dist = self.target_actor(s_rep)
+        else:
+            a_prime_dist = a_dist
         if self.discrete:
             a_dist = actor_critic.DiscreteLikeContinuous(a_dist)
+            a_prime_dist = actor_critic.DiscreteLikeContinuous(a_prime_dist)
 
         critic_loss = None
-        if not self.fake_filter or self.online_coeff > 0:
+        if needs_td_target:
             ########################
             ## Step 4: TD Targets ##
             ########################
-            with torch.no_grad():
-                if self.use_target_actor:
-                    a_prime_dist = self.target_actor(s_rep)
-                    if self.discrete:
-                        a_prime_dist = actor_critic.DiscreteLikeContinuous(a_prime_dist)
-                else:
-                    a_prime_dist = a_dist
+            with torch.no_grad(), self._td_target_stream():
                 ap = a_prime_dist.sample()
                 assert ap.shape == (B, L, G, D_action)
                 sp_ap_gp = (s_rep[:, 1:, ...].detach(), ap[:, 1:, ...].detach())
-                q_targ_sp_ap_gp, _ = self.target_critics(*sp_ap_gp)
+                # target critics are inference-only: with mixed precision on, run
+                # their matmuls in bf16 (the bin softmax stays fp32 under autocast)
+                with self.caster():
+                    q_targ_sp_ap_gp, _ = self.target_critics(*sp_ap_gp)
                 assert q_targ_sp_ap_gp.probs.shape == (B, L - 1, C, G, Bins)
-                q_targ_sp_ap_gp = self.target_critics.bin_dist_to_raw_vals(
-                    q_targ_sp_ap_gp
+                gamma = self._gammas_bcast
+                random_subset = redq_random_subset(
+                    B, L - 1, C, self.num_critics_td, device=r.device
                 )
-                assert q_targ_sp_ap_gp.shape == (B, L - 1, C, G, 1)
-                gamma = self.gammas.to(r.device).unsqueeze(-1)
-                ensemble_td_target = r + gamma * (1.0 - d) * q_targ_sp_ap_gp
-                assert ensemble_td_target.shape == (B, L - 1, C, G, 1)
-                random_subset = torch.randint(
-                    low=0,
-                    high=C,
-                    size=(B, L - 1, self.num_critics_td, G, 1),
-                    device=r.device,
-                )
-                td_target_rand = torch.take_along_dim(
-                    ensemble_td_target, random_subset, dim=2
-                )
-                td_target = td_target_rand.mean(2, keepdims=True)
-                assert td_target.shape == (B, L - 1, 1, G, 1)
-                # we are only using popart to track stats for online actor update,
-                # since scale intentionally does not impact critic loss
-                self.popart.update_stats(
-                    td_target, mask=critic_mask.all(2, keepdim=True)
+                # bins --> values --> TD target --> two-hot labels in one fused call
+                td_target, td_target_labels = self._two_hot_td_target_fn(
+                    r,
+                    d,
+                    gamma,
+                    q_targ_sp_ap_gp.probs,
+                    random_subset,
+                    self.target_critics.bin_vals,
+                    dtype=self._td_dtype,
                 )
                 assert td_target.shape == (B, L - 1, 1, G, 1)
-                td_target_labels = self.target_critics.raw_vals_to_labels(td_target)
-                td_target_labels = repeat(
-                    td_target_labels, f"b l 1 g bins -> b l {C} g bins"
-                )
-                assert td_target_labels.shape == (B, L - 1, C, G, Bins)
+                assert td_target_labels.shape == (B, L - 1, 1, G, Bins)
 
             #########################
             ## Step 5: Critic Loss ##
@@ -798,21 +1069,27 @@ class MultiTaskAgent(Agent):
             s_a_g = (s_rep, a_buffer)
             q_s_a_g, _ = self.critics(*s_a_g)
             assert q_s_a_g.probs.shape == (B, L, C, G, Bins)
-            critic_loss = F.cross_entropy(
-                rearrange(q_s_a_g.logits[:, :-1, ...], "b l c g u -> (b l c g) u"),
-                rearrange(td_target_labels, "b l c g u -> (b l c g) u"),
-                reduction="none",
-            )
-            critic_loss = rearrange(
-                critic_loss, "(b l c g) -> b l c g 1", b=B, l=L - 1, c=C, g=G
-            )
+            self._join_td_target_stream(td_target, td_target_labels)
+            # we are only using popart to track stats for online actor update,
+            # since scale intentionally does not impact critic loss
+            self.popart.update_stats(td_target, mask=critic_mask.all(2, keepdim=True))
+            # cross-entropy w/ soft labels; the labels broadcast over the critic dim.
+            # Categorical logits are already normalized log-probs, so no log_softmax
+            logp = q_s_a_g.logits[:, :-1, ...]
+            critic_loss = self._two_hot_loss_fn(td_target_labels, logp)
             assert critic_loss.shape == (B, L - 1, C, G, 1)
+            # scalar values of the online critics, shared by logging and the FBC filter
+            if log_step or (not self.fake_filter and self.offline_coeff > 0):
+                with torch.no_grad():
+                    raw_q_s_a_g = self.critics.bin_dist_to_raw_vals(q_s_a_g)
+                assert raw_q_s_a_g.shape == (B, L, C, G, 1)
             if log_step:
-                raw_q_s_a_g_ = self.critics.bin_dist_to_raw_vals(q_s_a_g)[:, :-1, ...]
+                raw_q_s_a_g_ = raw_q_s_a_g[:, :-1, ...]
                 td_stats = self._td_stats(
                     critic_mask,
                     raw_q_s_a_g_,
-                    self.popart.normalize_values(raw_q_s_a_g_),
+                    # rescaled stats come from the raw reductions
+                    None,
                     r,
                     td_target,
                     raw_q_bins=q_s_a_g.probs[:, :-1],
@@ -824,39 +1101,52 @@ class MultiTaskAgent(Agent):
         ## Step 6: FBC Loss ##
         ######################
         actor_loss = 0.0
-        if not self.fake_filter and self.offline_coeff > 0:
+        use_fbc_filter = not self.fake_filter and self.offline_coeff > 0
+        # the FBC value estimate and the DPG loss both see s_rep.detach() through
+        # critic weights that get no grads, so they can share the state features
+        s_feats = None
+        if use_fbc_filter and self.online_coeff > 0:
+            with torch.no_grad():
+                s_feats = self.critics.state_features(s_rep.detach())
+        # one reparameterized draw can serve both losses: the first sample
+        # keeps its grad for DPG, and all K are detached for the FBC filter
+        a_samples = None
+        if (
+            use_fbc_filter
+            and self.online_coeff > 0
+            and self.actor.actions_differentiable
+            and not self.discrete
+        ):
+            a_samples = a_dist.rsample((self.fbc_filter_k,))
+        if use_fbc_filter:
             with torch.no_grad():
                 K = self.fbc_filter_k
-                a_agent = rearrange(a_dist.sample((K,)), "k b l g a -> (b k) l g a")
-                s_rep_fbc = repeat(s_rep.detach(), "b l f -> (b k) l f", k=K)
-                s_a_agent = (s_rep_fbc, a_agent)
-                q_s_a_agent, phi_s_a_agent = self.critics(*s_a_agent)
-                assert q_s_a_agent.probs.shape == (B * K, L, C, G, Bins)
-                val_s = self.critics.bin_dist_to_raw_vals(q_s_a_agent).mean(2).detach()
-                assert val_s.shape == (B * K, L, G, 1)
-                val_s = rearrange(val_s, "(b k) l g 1 -> b k l g 1", k=K).mean(1)
+                # K action samples share one pass over the state features
+                if a_samples is not None:
+                    a_agent = a_samples.detach()
+                else:
+                    a_agent = a_dist.sample((K,))
+                with self.caster():
+                    q_s_a_agent, phi_s_a_agent = self.critics(
+                        s_rep.detach(), a_agent, state_feats=s_feats
+                    )
+                assert q_s_a_agent.probs.shape == (K, B, L, C, G, Bins)
+                # average over action samples and critics in one reduction
+                val_s = self.critics.bin_dist_to_raw_vals(q_s_a_agent).mean((0, 3))
                 assert val_s.shape == (B, L, G, 1)
-                q_s_a_g = self.critics.bin_dist_to_raw_vals(q_s_a_g).mean(2)
-                advantage_s_a = q_s_a_g - val_s
+                # subtract in place from the fresh mean instead of allocating again
+                advantage_s_a = raw_q_s_a_g.mean(2).sub_(val_s)
                 assert advantage_s_a.shape == (B, L, G, 1)
                 filter_ = self.fbc_filter_func(advantage_s_a)[:, :-1, ...].float()
                 binary_filter_ = binary_filter(advantage_s_a)[:, :-1, ...].float()
         else:
-            filter_ = binary_filter_ = torch.ones(
-                (B, L - 1, G, 1), dtype=torch.float32, device=s_rep.device
-            )
+            # Behavior Cloning (no filter to multiply by)
+            filter_ = binary_filter_ = None
 
         if self.offline_coeff > 0:
-            if self.discrete:
-                logp_a = a_dist.log_prob(a_buffer)
-            elif self.multibinary:
-                logp_a = a_dist.log_prob(a_buffer).mean(-1, keepdim=True)
-            else:
-                logp_a = a_dist.log_prob(a_buffer.clamp(-0.995, 0.995)).sum(
-                    -1, keepdim=True
-                )
+            logp_a = self._logp_fn(a_dist, a_buffer)
             logp_a = logp_a[:, :-1, ...].clamp(-1e3, 1e3)
-            actor_loss += self.offline_coeff * -(filter_.detach() * logp_a)
+            actor_loss += self.offline_coeff * -filtered(filter_, logp_a)
             if log_step:
                 policy_stats = self._policy_stats(actor_mask, a_dist)
                 filter_stats = self._filter_stats(actor_mask, logp_a, binary_filter_)
@@ -869,13 +1159,17 @@ class MultiTaskAgent(Agent):
             assert (
                 self.actor.actions_differentiable and not self.discrete
             ), "this ablation only supports continuous actions with rsample()"
-            a_agent = a_dist.rsample()
-            q_s_a_agent, _ = self.maximized_critics(s_rep.detach(), a_agent)
+            a_agent = a_samples[0] if a_samples is not None else a_dist.rsample()
+            q_s_a_agent, _ = self.maximized_critics(
+                s_rep.detach(), a_agent, state_feats=s_feats
+            )
             q_s_a_agent = self.popart.normalize_values(
-                self.maximized_critics.bin_dist_to_raw_vals(q_s_a_agent).min(2).values
+                self.critics.bin_dist_to_raw_vals(q_s_a_agent).min(2).values
             )
             actor_loss += self.online_coeff * -(q_s_a_agent[:, :-1, ...])
 
+        if not isinstance(actor_loss, torch.Tensor):
+            actor_loss = s_rep.new_zeros((B, L - 1, G, 1))
         return critic_loss, actor_loss
 
     def _td_stats(self, mask, raw_q_s_a_g, q_s_a_g, r, td_target, raw_q_bins) -> dict:
@@ -886,18 +1180,24 @@ class MultiTaskAgent(Agent):
             r=r,
             td_target=td_target,
         )
-        *_, Bins = raw_q_bins.shape
-        max_bin_all_gammas_histogram = raw_q_bins.argmax(-1)[torch.where(mask.all(-1))]
-        max_bin_target_gamma_histogram = raw_q_bins[..., -1, :].argmax(-1)[
-            torch.where(mask[..., -1, :].all(-1))
-        ]
+        *_, G, Bins = raw_q_bins.shape
+        # count bins on device and only move the (G, Bins) counts to the cpu
+        max_bin = raw_q_bins.argmax(-1)
+        gamma_offset = torch.arange(G, device=max_bin.device) * Bins
+        max_bin_counts = torch.bincount(
+            (max_bin + gamma_offset).flatten(),
+            weights=mask.all(-1).expand_as(max_bin).flatten().float(),
+            minlength=G * Bins,
+        )
+        max_bin_counts = max_bin_counts.view(G, Bins).cpu().numpy()
+        bin_edges = np.arange(Bins + 1)
         stats.update(
             {
                 "Maximum Bin (All Gammas)": wandb.Histogram(
-                    max_bin_all_gammas_histogram.cpu().numpy(), num_bins=Bins
+                    np_histogram=(max_bin_counts.sum(0), bin_edges)
                 ),
                 "Maximum Bin (Target Gamma)": wandb.Histogram(
-                    max_bin_target_gamma_histogram.cpu().numpy(), num_bins=Bins
+                    np_histogram=(max_bin_counts[-1], bin_edges)
                 ),
             }
         )
@@ -20,6 +20,12 @@ from amago.utils import amago_warning
 
 
 class DummyAsyncVectorEnv(gym.Env):
+    """
+    Steps every actor in the main process (`Experiment.async_envs = False`), which
+    skips the subprocess pipes and pickling of `gym.vector.AsyncVectorEnv`. Usually
+    the faster choice for cheap envs.
+    """
+
     def __init__(self, env_funcs):
         self.envs = [e() for e in env_funcs]
         self.observation_space = self.envs[0].observation_space
@@ -32,10 +38,9 @@ class DummyAsyncVectorEnv(gym.Env):
         return np.stack([o[0] for o in outs], axis=0), [o[1] for o in outs]
 
     def call_async(self, prop):
-        try:
-            self._call_buffer = [eval(f"e.{prop}()") for e in self.envs]
-        except:
-            self._call_buffer = [eval(f"e.{prop}") for e in self.envs]
+        # called every timestep (`current_timestep`), so avoid re-parsing `prop`
+        attrs = [getattr(e, prop) for e in self.envs]
+        self._call_buffer = [a() if callable(a) else a for a in attrs]
 
     def call_wait(self):
         return self._call_buffer
@@ -50,15 +55,12 @@ class DummyAsyncVectorEnv(gym.Env):
             outs.append(self.envs[i].step(action[i]))
         states = [o[0] for o in outs]
         rewards = np.stack([o[1] for o in outs], axis=0)
-        te = [o[2] for o in outs]
-        tr = [o[3] for o in outs]
+        te = np.array([o[2] for o in outs])
+        tr = np.array([o[3] for o in outs])
         info = [o[4] for o in outs]
 
-        for i, (terminal, truncated) in enumerate(zip(te, tr)):
-            if terminal or truncated:
-                states[i], info[i] = self.envs[i].reset()
-        te = np.stack(te, axis=0)
-        tr = np.stack(tr, axis=0)
+        for i in np.flatnonzero(te | tr):
+            states[i], info[i] = self.envs[i].reset()
         states = np.stack(states, axis=0)
 
         return states, rewards, te, tr, info
@@ -123,6 +125,37 @@ class MultiBinaryActionWrapper(gym.ActionWrapper):
         return action.astype(np.int8)
 
 
+class PinnedStagingBuffer:
+    """
+    Reusable (pinned, when targeting cuda) host memory for one timestep of
+    per-actor arrays. Actor arrays are copied straight into it without an
+    `np.stack`, and it is moved to the device with a non-blocking copy.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.pin = self.device.type == "cuda"
+        self._buffers = {}
+        self._copy_done = {}
+
+    def to_device(self, key: str, arrays: list[np.ndarray]) -> torch.Tensor:
+        shape = (len(arrays),) + arrays[0].shape
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != shape:
+            dtype = torch.from_numpy(arrays[0]).dtype
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=self.pin)
+            self._buffers[key] = buffer
+        elif key in self._copy_done:
+            # don't overwrite the host memory of a transfer that is still in flight
+            self._copy_done[key].synchronize()
+        for i, array in enumerate(arrays):
+            buffer[i].copy_(torch.from_numpy(array))
+        out = buffer.to(self.device, non_blocking=self.pin)
+        if self.pin:
+            self._copy_done.setdefault(key, torch.cuda.Event()).record()
+        return out
+
+
 class GPUSequenceBuffer:
     def __init__(self, device, max_len: int, num_parallel: int):
         self.device = device
@@ -142,12 +175,19 @@ class GPUSequenceBuffer:
             dtype=array.dtype, device=self.device
         )
 
-    def add_timestep(self, arrays: np.ndarray | dict[np.ndarray], dones=None):
+    def add_timestep(
+        self,
+        arrays: np.ndarray | torch.Tensor | dict[np.ndarray | torch.Tensor],
+        dones=None,
+    ):
         if not isinstance(arrays, dict):
             arrays = {"_": arrays}
 
         for k in arrays.keys():
-            v = torch.from_numpy(arrays[k]).to(self.device)
+            v = arrays[k]
+            if isinstance(v, np.ndarray):
+                v = torch.from_numpy(v)
+            v = v.to(self.device)
             assert v.shape[0] == self.num_parallel
             assert v.shape[1] == 1
             arrays[k] = v
@@ -13,7 +13,6 @@ import wandb
 import torch
 from torch.utils.data import DataLoader
 import numpy as np
-from einops import repeat
 import gymnasium as gym
 from accelerate import Accelerator, DistributedDataParallelKwargs
 from accelerate.utils import tqdm
@@ -27,6 +26,7 @@ from amago.envs.env_utils import (
     EpsilonGreedy,
     SequenceWrapper,
     GPUSequenceBuffer,
+    PinnedStagingBuffer,
     DummyAsyncVectorEnv,
     EnvCreator,
 )
@@ -85,6 +85,7 @@ class Experiment:
     batch_size: int = 24
     batches_per_update: int = 1
     dloader_workers: int = 6
+    dloader_prefetch_factor: int = 2
     learning_rate: float = 1e-4
     critic_loss_weight: float = 10.0
     lr_warmup_steps: int = 500
@@ -92,6 +93,8 @@ class Experiment:
     l2_coeff: float = 1e-3
     fast_inference: bool = True
     mixed_precision: str = "no"
+    compile_tstep_encoder: bool = False
+    bf16_rollouts: bool = True
 
     def start(self):
         self.accelerator = Accelerator(
@@ -223,6 +226,7 @@ class Experiment:
         # that are shorter than the horizon length
         self.train_buffers = None
         self.hidden_state = None
+        self._count_frames()
 
     def init_checkpoints(self):
         self.ckpt_dir = os.path.join(
@@ -289,10 +293,19 @@ class Experiment:
             num_workers=self.dloader_workers,
             collate_fn=RLData_pad_collate,
             pin_memory=True,
+            # workers outlive each pass over the loader and pick up new files
+            # through `TrajDset.refresh_files`
+            persistent_workers=self.dloader_workers > 0,
+            prefetch_factor=(
+                self.dloader_prefetch_factor if self.dloader_workers > 0 else None
+            ),
         )
         # accelerator.free_memory clears everything.
         # https://github.com/huggingface/accelerate/blob/2471eacdd648446f2f63eccb9b18a7731304f401/src/accelerate/accelerator.py#L3189
-        self.train_dloader = self.accelerator.prepare(train_dloader)
+        # (batches arrive pinned and `train_step` moves them with non_blocking copies)
+        self.train_dloader = self.accelerator.prepare_data_loader(
+            train_dloader, device_placement=False
+        )
 
     def init_logger(self):
         gin_config = gin.operative_config_str()
@@ -327,10 +340,12 @@ class Experiment:
             "max_seq_len": self.max_seq_len,
             "horizon": self.horizon,
             "device": self.DEVICE,
+            # the agent casts its own no-grad passes (and `Agent.update`) with this
+            "mixed_precision": "bf16" if self.mixed_precision == "bf16" else "no",
         }
         policy = self.agent_type(**policy_kwargs)
         assert isinstance(policy, Agent)
-        optimizer = torch.optim.AdamW(
+        optimizer = utils.get_adamw(
             policy.trainable_params,
             lr=self.learning_rate,
             weight_decay=self.l2_coeff,
@@ -342,6 +357,18 @@ class Experiment:
             policy, optimizer, lr_schedule
         )
         self.accelerator.register_for_checkpointing(self.lr_schedule)
+        if self.compile_tstep_encoder:
+            # compiled in place, so parameter names (and checkpoints) are unchanged.
+            # sequence lengths vary during rollouts: let dynamo mark them dynamic
+            # after the first recompile instead of specializing on every length
+            tstep_encoder = self.policy.tstep_encoder
+            if hasattr(tstep_encoder, "compile"):
+                tstep_encoder.compile(dynamic=None)
+            else:
+                # torch < 2.2 has no `nn.Module.compile`
+                tstep_encoder.forward = torch.compile(
+                    tstep_encoder.forward, dynamic=None
+                )
 
     @property
     def policy(self):
@@ -395,22 +422,28 @@ class Experiment:
                 self.parallel_actors, self.DEVICE
             )
 
+        # actor timesteps are copied into reused pinned memory, then sent to the device
+        staging = PinnedStagingBuffer(self.DEVICE)
+        # hidden state resets (in-place) overlap with those copies on a side stream
+        reset_stream = (
+            torch.cuda.Stream(self.DEVICE) if self.DEVICE.type == "cuda" else None
+        )
+
         def get_t(_dones=None):
-            par_obs_goal_rl2 = utils.call_async_env(envs, "current_timestep")
-            _obs = utils.stack_list_array_dicts(
-                [obs_goal_rl2[0] for obs_goal_rl2 in par_obs_goal_rl2], axis=0
-            )
-            _goal = np.stack(
-                [obs_goal_rl2[1] for obs_goal_rl2 in par_obs_goal_rl2], axis=0
-            )
-            _rl2 = np.stack(
-                [obs_goal_rl2[2] for obs_goal_rl2 in par_obs_goal_rl2], axis=0
-            )
+            # (the caller has already sent `envs.call_async("current_timestep")`)
+            par_obs, par_goal, par_rl2 = zip(*envs.call_wait())
+            _obs = {
+                k: staging.to_device(f"obs_{k}", [o[k] for o in par_obs])
+                for k in par_obs[0].keys()
+            }
+            _goal = staging.to_device("goal", par_goal)
+            _rl2 = staging.to_device("rl2", par_rl2)
             obs_seqs.add_timestep(_obs, _dones)
             goal_seqs.add_timestep(_goal, _dones)
             rl2_seqs.add_timestep(_rl2, _dones)
 
         if buffers is None:
+            envs.call_async("current_timestep")
             get_t()
 
         for _ in iter_:
@@ -421,7 +454,7 @@ class Experiment:
             time_idxs = obs_seqs.time_idxs
 
             with torch.no_grad():
-                with self.caster():
+                with self.rollout_caster():
                     actions, hidden_state = policy.get_actions(
                         obs=obs_tc_t,
                         goals=goals_tc_t,
@@ -433,8 +466,19 @@ class Experiment:
                     )
             *_, terminated, truncated, _ = envs.step(actions)
             done = terminated | truncated
-            get_t(done)
-            hidden_state = policy.traj_encoder.reset_hidden_state(hidden_state, done)
+            # the actors gather their next timestep while we reset the hidden state
+            envs.call_async("current_timestep")
+            if reset_stream is not None:
+                reset_stream.wait_stream(torch.cuda.current_stream(self.DEVICE))
+                with torch.cuda.stream(reset_stream):
+                    hidden_state = policy.traj_encoder.reset_hidden_state(
+                        hidden_state, done
+                    )
+                get_t(done)
+                torch.cuda.current_stream(self.DEVICE).wait_stream(reset_stream)
+            else:
+                hidden_state = policy.traj_encoder.reset_hidden_state(hidden_state, done)
+                get_t(done)
 
             if render:
                 envs.render()
@@ -455,6 +499,7 @@ class Experiment:
                 self.train_timesteps_per_epoch,
                 buffers=self.train_buffers,
             )
+            self._count_frames()
 
     def evaluate_val(self):
         if self.val_timesteps_per_epoch > 0:
@@ -489,32 +534,42 @@ class Experiment:
 
     def log(self, metrics_dict, key):
         log_dict = {}
+        scalars_by_device = defaultdict(dict)
         for k, v in metrics_dict.items():
             if isinstance(v, torch.Tensor):
                 if v.ndim == 0:
-                    log_dict[k] = v.detach().cpu().float().item()
+                    scalars_by_device[v.device][k] = v.detach().float()
             else:
                 log_dict[k] = v
+        # one device --> host copy (and sync) for all the scalar stats
+        for scalars in scalars_by_device.values():
+            values = torch.stack(list(scalars.values())).cpu().tolist()
+            log_dict.update(zip(scalars.keys(), values))
 
-        total_frames = sum(utils.call_async_env(self.train_envs, "total_frames"))
-        frames_by_env_name = utils.call_async_env(
-            self.train_envs, "total_frames_by_env_name"
-        )
-        total_frames_by_env_name = defaultdict(int)
-        for env_frames in frames_by_env_name:
-            for env_name, frames in env_frames.items():
-                total_frames_by_env_name[f"total_frames-{env_name}"] += frames
         if self.log_to_wandb:
             progress = {
                 "epoch": self.epoch,
-                "total_frames": total_frames,
+                "total_frames": self._total_frames,
             }
             self.accelerator.log(
                 {f"{key}/{subkey}": val for subkey, val in log_dict.items()}
                 | progress
-                | dict(total_frames_by_env_name)
+                | self._total_frames_by_env_name
             )
 
+    def _count_frames(self):
+        # frame counts only change during `collect_new_training_data`, so `log`
+        # reads these instead of querying every env each time
+        self._total_frames = sum(utils.call_async_env(self.train_envs, "total_frames"))
+        frames_by_env_name = utils.call_async_env(
+            self.train_envs, "total_frames_by_env_name"
+        )
+        total_frames_by_env_name = defaultdict(int)
+        for env_frames in frames_by_env_name:
+            for env_name, frames in env_frames.items():
+                total_frames_by_env_name[f"total_frames-{env_name}"] += frames
+        self._total_frames_by_env_name = dict(total_frames_by_env_name)
+
     def make_figures(self, loss_info) -> dict[str, wandb.Image]:
         """
         Override this to create polished figures from raw logging
@@ -523,31 +578,26 @@ class Experiment:
         return {}
 
     def policy_metrics(self, returns: ReturnHistory, successes: SuccessHistory):
-        return_by_env_name = {}
-        success_by_env_name = {}
+        # extend fresh lists (the old `+=` on the first env's list mutated its history)
+        return_by_env_name = defaultdict(list)
+        success_by_env_name = defaultdict(list)
         for ret, suc in zip(returns, successes):
             for env_name, scores in ret.data.items():
-                if env_name in return_by_env_name:
-                    return_by_env_name[env_name] += scores
-                else:
-                    return_by_env_name[env_name] = scores
+                return_by_env_name[env_name].extend(scores)
             for env_name, scores in suc.data.items():
-                if env_name in success_by_env_name:
-                    success_by_env_name[env_name] += scores
-                else:
-                    success_by_env_name[env_name] = scores
+                success_by_env_name[env_name].extend(scores)
 
         avg_ret_per_env = {
-            f"Average Total Return in {name}": np.array(scores).mean()
+            f"Average Total Return in {name}": np.mean(scores)
             for name, scores in return_by_env_name.items()
         }
         avg_suc_per_env = {
-            f"Average Success Rate in {name}": np.array(scores).mean()
+            f"Average Success Rate in {name}": np.mean(scores)
             for name, scores in success_by_env_name.items()
         }
         avg_return_overall = {
-            "Average Total Return (Across All Env Names)": np.array(
-                list(avg_ret_per_env.values())
+            "Average Total Return (Across All Env Names)": np.fromiter(
+                avg_ret_per_env.values(), dtype=np.float64, count=len(avg_ret_per_env)
             ).mean()
         }
         return avg_ret_per_env | avg_suc_per_env | avg_return_overall
@@ -555,15 +605,20 @@ class Experiment:
     def compute_loss(self, batch: Batch, log_step: bool):
         critic_loss, actor_loss = self.policy_aclr(batch, log_step=log_step)
         update_info = self.policy.update_info
-        B, L_1, G, _ = actor_loss.shape
-        C = len(self.policy.critics)
-        state_mask = (~((batch.rl2s == MAGIC_PAD_VAL).all(-1, keepdim=True))).float()
-        critic_state_mask = repeat(state_mask[:, 1:, ...], f"B L 1 -> B L {C} {G} 1")
-        actor_state_mask = repeat(state_mask[:, :-1, ...], f"B L 1 -> B L {G} 1")
+        # reuse the padding mask built during the policy's forward pass.
+        # (B, L, 1) --> broadcasts over the gamma (and critic) dims of the losses
+        state_mask, *_ = self.policy._cached_masks
+        if batch.fully_packed:
+            # no padding: the masked averages reduce to plain means
+            avg = lambda loss, _mask: loss.mean()
+        else:
+            avg = utils.masked_avg
+        actor_state_mask = state_mask[:, :-1, None, ...]
+        critic_state_mask = state_mask[:, 1:, None, None, ...]
 
-        masked_actor_loss = utils.masked_avg(actor_loss, actor_state_mask)
+        masked_actor_loss = avg(actor_loss, actor_state_mask)
         if isinstance(critic_loss, torch.Tensor):
-            masked_critic_loss = utils.masked_avg(critic_loss, critic_state_mask)
+            masked_critic_loss = avg(critic_loss, critic_state_mask)
         else:
             assert critic_loss is None
             masked_critic_loss = 0.0
@@ -575,18 +630,19 @@ class Experiment:
         } | update_info
 
     def _get_grad_norms(self):
-        ggn = utils.get_grad_norm
         pi = self.policy
-        grads = {
-            "Actor Grad Norm": ggn(pi.actor),
-            "Critic Grad Norm": ggn(pi.critics),
-            "TrajEncoder Grad Norm": ggn(pi.traj_encoder),
-            "TstepEncoder Grad Norm": ggn(pi.tstep_encoder),
-            "TstepEncoder Goal Emb. Grad Norm": ggn(pi.tstep_encoder.goal_emb),
-        }
-        return grads
+        return utils.get_grad_norms(
+            {
+                "Actor Grad Norm": pi.actor,
+                "Critic Grad Norm": pi.critics,
+                "TrajEncoder Grad Norm": pi.traj_encoder,
+                "TstepEncoder Grad Norm": pi.tstep_encoder,
+                "TstepEncoder Goal Emb. Grad Norm": pi.tstep_encoder.goal_emb,
+            }
+        )
 
     def train_step(self, batch: Batch, log_step: bool):
+        batch = batch.to(self.DEVICE, non_blocking=True)
         with self.accelerator.accumulate(self.policy_aclr):
             self.optimizer.zero_grad()
             l = self.compute_loss(batch, log_step=log_step)
@@ -609,6 +665,16 @@ class Experiment:
         else:
             return contextlib.suppress()
 
+    def rollout_caster(self):
+        # rollouts are forward-only, so bf16 is safe regardless of `mixed_precision`
+        if (
+            self.bf16_rollouts
+            and self.DEVICE.type == "cuda"
+            and torch.cuda.is_bf16_supported()
+        ):
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return self.caster()
+
     def learn(self):
         def make_pbar(loader, epoch_num):
             if self.verbose:
@@ -633,7 +699,8 @@ class Experiment:
             if epoch >= self.start_collecting_at_epoch:
                 self.collect_new_training_data()
             self.accelerator.wait_for_everyone()
-            self.init_dloaders()
+            # the (persistent) dataloader workers see the new files on their next sample
+            self.train_dset.refresh_files()
             if self.train_dset.count_trajectories() == 0:
                 utils.amago_warning(
                     f"Skipping epoch {epoch} because no training trajectories have been saved yet..."
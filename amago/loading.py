@@ -2,9 +2,11 @@ import os
 import random
 import shutil
 import pickle
+import multiprocessing as mp
 from dataclasses import dataclass
 from operator import itemgetter
 from functools import partial
+from typing import Optional
 
 import torch
 from torch.nn.utils.rnn import pad_sequence
@@ -54,6 +56,10 @@ class TrajDset(Dataset):
         )
         self.length = items_per_epoch if dset_name else None
         self.filenames = []
+        # persistent DataLoader workers hold their own copy of the dataset and
+        # re-list the directory when this counter moves past their copy's
+        self._files_version = mp.Value("i", 0)
+        self._seen_files_version = 0
         self.refresh_files()
         self.relabeler = relabeler
 
@@ -77,11 +83,17 @@ class TrajDset(Dataset):
             shutil.rmtree(self.dset_path)
             os.makedirs(self.dset_path)
 
-    def refresh_files(self):
-        # find the new .traj files from the previous rollout
+    def _list_files(self):
         if self.dset_path is not None and os.path.exists(self.dset_path):
             self.filenames = os.listdir(self.dset_path)
 
+    def refresh_files(self):
+        # find the new .traj files from the previous rollout
+        self._list_files()
+        with self._files_version.get_lock():
+            self._files_version.value += 1
+            self._seen_files_version = self._files_version.value
+
     def count_trajectories(self) -> int:
         # get the real dataset size
         return len(self.filenames)
@@ -111,6 +123,10 @@ class TrajDset(Dataset):
             os.remove(os.path.join(self.dset_path, file_to_delete))
 
     def __getitem__(self, i):
+        if self._seen_files_version != self._files_version.value:
+            # worker process: catch up with `refresh_files` in the main process
+            self._seen_files_version = self._files_version.value
+            self._list_files()
         filename = random.choice(self.filenames)
         traj = load_traj_from_disk(os.path.join(self.dset_path, filename))
         if isinstance(traj, Trajectory):
@@ -131,7 +147,8 @@ class RLData:
         self.rl2s = torch.from_numpy(traj.rl2s).float()
         self.time_idxs = torch.from_numpy(traj.time_idxs).long()
         self.rews = torch.from_numpy(traj.rews).float()
-        self.dones = torch.from_numpy(traj.dones).bool()
+        # float here so the training step does not have to cast on device
+        self.dones = torch.from_numpy(traj.dones).float()
         self.actions = torch.from_numpy(traj.actions).float()
 
     def __len__(self):
@@ -167,15 +184,37 @@ class Batch:
     dones: torch.Tensor
     actions: torch.Tensor
     time_idxs: torch.Tensor
+    # (B, L, 1) float, 1.0 where the timestep is not padding
+    pad_mask: Optional[torch.Tensor] = None
+    # True when no sequence in the batch is padded (so `pad_mask` is all ones)
+    fully_packed: bool = False
+
+    def pin_memory(self):
+        # called by the DataLoader's pin memory thread (`pin_memory=True`)
+        pin = lambda x: x.pin_memory()
+        self.obs = {k: pin(v) for k, v in self.obs.items()}
+        self.goals = pin(self.goals)
+        self.rl2s = pin(self.rl2s)
+        self.rews = pin(self.rews)
+        self.dones = pin(self.dones)
+        self.actions = pin(self.actions)
+        self.time_idxs = pin(self.time_idxs)
+        if self.pad_mask is not None:
+            self.pad_mask = pin(self.pad_mask)
+        return self
 
-    def to(self, device):
-        self.obs = {k: v.to(device) for k, v in self.obs.items()}
-        self.goals = self.goals.to(device)
-        self.rl2s = self.rl2s.to(device)
-        self.rews = self.rews.to(device)
-        self.dones = self.dones.to(device)
-        self.actions = self.actions.to(device)
-        self.time_idxs = self.time_idxs.to(device)
+    def to(self, device, non_blocking: bool = False):
+        # non_blocking overlaps the copy with compute when the batch is in pinned memory
+        to = lambda x: x.to(device, non_blocking=non_blocking)
+        self.obs = {k: to(v) for k, v in self.obs.items()}
+        self.goals = to(self.goals)
+        self.rl2s = to(self.rl2s)
+        self.rews = to(self.rews)
+        self.dones = to(self.dones)
+        self.actions = to(self.actions)
+        self.time_idxs = to(self.time_idxs)
+        if self.pad_mask is not None:
+            self.pad_mask = to(self.pad_mask)
         return self
 
 
@@ -188,6 +227,10 @@ def RLData_pad_collate(samples: list[RLData]) -> Batch:
     dones = pad([s.dones for s in samples])
     actions = pad([s.actions for s in samples])
     time_idxs = pad([s.time_idxs for s in samples])
+    # built by the dataloader workers so the training step doesn't have to
+    pad_mask = (rl2s != MAGIC_PAD_VAL).any(-1, keepdim=True).float()
+    # (checked on the host here, never on the device)
+    fully_packed = bool(pad_mask.all())
     return Batch(
         obs=obs,
         goals=goals,
@@ -196,4 +239,6 @@ def RLData_pad_collate(samples: list[RLData]) -> Batch:
         dones=dones,
         actions=actions,
         time_idxs=time_idxs,
+        pad_mask=pad_mask,
+        fully_packed=fully_packed,
     )
@@ -5,7 +5,6 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch import distributions as pyd
-from einops import repeat, rearrange
 from einops.layers.torch import EinMix as Mix
 import gin
 
@@ -94,6 +93,20 @@ class _TanhTransform(pyd.transforms.Transform):
         return 2.0 * (math.log(2.0) - x - F.softplus(-2.0 * x))
 
 
+@torch.jit.script
+def _squashed_normal_log_prob(loc, scale, value, clip: float):
+    # atanh --> Normal log_prob --> tanh jacobian --> sum over action dims, fused
+    y = value.clamp(-clip, clip)
+    x = 0.5 * (y.log1p() - (-y).log1p())
+    normal_lp = (
+        -((x - loc) ** 2) / (2.0 * scale**2)
+        - scale.log()
+        - 0.5 * math.log(2.0 * math.pi)
+    )
+    log_abs_det = 2.0 * (math.log(2.0) - x - F.softplus(-2.0 * x))
+    return (normal_lp - log_abs_det).sum(-1, keepdim=True)
+
+
 class _SquashedNormal(pyd.transformed_distribution.TransformedDistribution):
     # Credit: https://github.com/denisyarats/pytorch_sac/blob/master/agent/actor.py
     def __init__(self, loc, scale):
@@ -104,6 +117,14 @@ class _SquashedNormal(pyd.transformed_distribution.TransformedDistribution):
         transforms = [_TanhTransform()]
         super().__init__(self.base_dist, transforms)
 
+    def summed_log_prob(self, value):
+        """
+        `log_prob(value).sum(-1, keepdim=True)` for actions that were not sampled from
+        this distribution, in one scripted kernel. Uses the same [-.99, .99]
+        clip as `_TanhTransform._inverse`.
+        """
+        return _squashed_normal_log_prob(self.loc, self.scale, value, 0.99)
+
     @property
     def mean(self):
         mu = self.loc
@@ -139,10 +160,9 @@ def ContinuousActionDist(
     elif kind == "gmm":
         assert d_action is not None and gmm_modes is not None
         idx = gmm_modes * d_action
-        means = rearrange(vec[..., :idx], "... g (m p) -> ... g m p", m=gmm_modes)
-        log_std = rearrange(
-            vec[..., idx : 2 * idx], "... g (m p) -> ... g m p", m=gmm_modes
-        )
+        # ... g (m p) -> ... g m p
+        means = vec[..., :idx].unflatten(-1, (gmm_modes, -1))
+        log_std = vec[..., idx : 2 * idx].unflatten(-1, (gmm_modes, -1))
         log_std = log_std_low + 0.5 * (log_std_high - log_std_low) * (log_std + 1)
         stds = log_std.exp()
         logits = vec[..., 2 * idx :]
@@ -246,9 +266,8 @@ class Actor(nn.Module):
 
     def forward(self, state):
         dist_params = self.base(state)
-        dist_params = rearrange(
-            dist_params, "b ... (g f) -> b ... g f", g=self.num_gammas
-        )
+        # b ... (g f) -> b ... g f
+        dist_params = dist_params.unflatten(-1, (self.num_gammas, -1))
         if self.discrete:
             return DiscreteActionDist(dist_params)
         else:
@@ -307,8 +326,29 @@ class _EinMixEnsemble(nn.Module):
         self.dropout = nn.Dropout(dropout_p)
         self.activation = activation_switch(activation)
 
-    def forward(self, inp):
-        phis = self.dropout(self.activation(self.inp_layer(inp)))
+    def shared_features(self, shared_inp):
+        # first layer contribution of the leading `shared_inp` input features
+        weight = self.inp_layer.weight[:, : shared_inp.shape[-1]]
+        return torch.einsum("...d,cdo->...co", shared_inp, weight)
+
+    def forward(self, inp, shared_inp=None, shared_feats=None):
+        if shared_inp is None and shared_feats is None:
+            phis = self.inp_layer(inp)
+        else:
+            # `shared_inp` holds the leading input features, which broadcast over
+            # the leading dims of `inp`. Its share of the first layer is computed once
+            # (or passed in precomputed as `shared_feats`).
+            if shared_feats is None:
+                shared_feats = self.shared_features(shared_inp)
+            weight, bias = self.inp_layer.weight, self.inp_layer.bias
+            d_shared = weight.shape[1] - inp.shape[-1]
+            phis = (
+                shared_feats
+                + torch.einsum("...d,cdo->...co", inp, weight[:, d_shared:])
+                + bias
+            )
+            phis = phis.flatten(0, -4)
+        phis = self.dropout(self.activation(phis))
         for layer in self.core_layers:
             phis = self.dropout(self.activation(layer(phis)))
         outputs = self.output_layer(phis)
@@ -337,6 +377,8 @@ class NCritics(nn.Module):
         inp_dim = state_dim
         self.num_gammas = len(gammas)
         self.gammas = gammas
+        # per-gamma input feature, precomputed so it follows the module's device
+        self.register_buffer("_gamma_feats", gammas.log() * 10.0, persistent=False)
         if not discrete:
             inp_dim += action_dim + 1
             out_dim = 1
@@ -363,19 +405,22 @@ class NCritics(nn.Module):
         else:
             assert action.dim() == 4
             B, L, G, D = action.shape
-            state = repeat(state, "b l d -> (b g) l d", g=self.num_gammas)
-            action = rearrange(action, "b l g d -> (b g) l d")
-            gammas = self.gammas.to(action.device).log() * 10.0
-            gammas = repeat(gammas, "g -> (b g) l 1", b=B, l=L)
+            # b l d -> (b g) l d
+            state = state.unsqueeze(1).expand(B, G, L, -1).reshape(B * G, L, -1)
+            action = action.transpose(1, 2).reshape(B * G, L, D)
+            gammas = self._gamma_feats.view(1, G, 1, 1).expand(B, G, L, 1)
+            gammas = gammas.reshape(B * G, L, 1)
             # clip to remove DPG incentive to push actions to [-1, 1] border
             clip_action = action.clamp(-0.999, 0.999)
             inp = torch.cat((state, gammas, clip_action), dim=-1)
         outputs, phis = self.net(inp)
         if self.discrete:
-            outputs = rearrange(outputs, "b l c (g o) -> b l c g o", g=self.num_gammas)
+            # b l c (g o) -> b l c g o
+            outputs = outputs.unflatten(-1, (self.num_gammas, -1))
             outputs = (outputs * clip_action.unsqueeze(2)).sum(-1, keepdims=True)
         else:
-            outputs = rearrange(outputs, "(b g) l c o -> b l c g o", g=self.num_gammas)
+            # (b g) l c o -> b l c g o
+            outputs = outputs.view(B, G, *outputs.shape[1:]).permute(0, 2, 3, 1, 4)
         return outputs, phis
 
 
@@ -400,6 +445,11 @@ class NCriticsTwoHot(nn.Module):
         self.num_gammas = len(gammas)
         self.action_dim = action_dim
         self.gammas = gammas
+        self.register_buffer(
+            "_gamma_feats",
+            torch.arange(self.num_gammas, dtype=torch.float32) / self.num_gammas,
+            persistent=False,
+        )
         inp_dim = state_dim + action_dim + 1
         out_dim = output_bins
         self.num_bins = output_bins
@@ -410,8 +460,10 @@ class NCriticsTwoHot(nn.Module):
         min_return = min_return or -100_000
         max_return = max_return or 100_000
         assert min_return < max_return
-        self.bin_vals = torch.linspace(
-            symlog(min_return), symlog(max_return), output_bins
+        self.register_buffer(
+            "bin_vals",
+            torch.linspace(symlog(min_return), symlog(max_return), output_bins),
+            persistent=False,
         )
         self.net = _EinMixEnsemble(
             ensemble_size=num_critics,
@@ -426,62 +478,93 @@ class NCriticsTwoHot(nn.Module):
     def __len__(self):
         return self.num_critics
 
-    def forward(self, state: torch.Tensor, action: torch.Tensor):
-        assert action.dim() == 4
-        B, L, G, D = action.shape
+    def state_features(self, state: torch.Tensor):
+        """
+        The state's share of the first layer, which can be passed to `forward` as
+        `state_feats` to reuse it across calls on the same (B, L, D_state) state.
+        """
+        return self.net.shared_features(state[:, None])
+
+    def forward(
+        self,
+        state: torch.Tensor,
+        action: torch.Tensor,
+        state_feats: Optional[torch.Tensor] = None,
+    ):
+        """
+        state: (B, L, D_state), action: (B, L, G, D_action) or (K, B, L, G, D_action)
+        for K action samples per state. The state's share of the first layer is
+        computed once and broadcast over samples and gammas.
+        """
+        sampled = action.dim() == 5
+        if not sampled:
+            action = action.unsqueeze(0)
+        K, B, L, G, D = action.shape
         assert G == self.num_gammas
 
-        state = repeat(state, "b l d -> (b g) l d", g=self.num_gammas)
-        action = rearrange(action.clamp(-0.995, 0.995), "b l g d -> (b g) l d")
-        gammas = (
-            torch.arange(self.num_gammas, dtype=action.dtype, device=action.device)
-            / self.num_gammas
+        gammas = self._gamma_feats.to(action.dtype).view(1, 1, 1, G, 1)
+        gammas = gammas.expand(K, B, L, G, 1)
+        inp = torch.cat((gammas, action.clamp(-0.995, 0.995)), dim=-1)
+        # k b l g d -> k b g l d
+        inp = inp.transpose(2, 3)
+        outputs, phis = self.net(
+            inp, shared_inp=state[:, None], shared_feats=state_feats
         )
-        gammas = repeat(gammas, "g -> (b g) l 1", b=B, l=L)
-        inp = torch.cat((state, gammas, action), dim=-1)
-        outputs, phis = self.net(inp)
-        outputs = rearrange(outputs, "(b g) l c o -> b l c g o", g=self.num_gammas)
-        val_dist = pyd.Categorical(logits=outputs)
-        clip_probs = val_dist.probs.clamp(1e-6, 0.999)
+        # (k b g) l c o -> k b l c g o
+        outputs = outputs.view(K, B, G, *outputs.shape[1:]).permute(0, 1, 3, 4, 2, 5)
+        if not sampled:
+            outputs = outputs.squeeze(0)
+        clip_probs = F.softmax(outputs, dim=-1).clamp(1e-6, 0.999)
         safe_probs = clip_probs / clip_probs.sum(-1, keepdims=True).detach()
         safe_dist = pyd.Categorical(probs=safe_probs)
         return safe_dist, phis
 
     def bin_dist_to_raw_vals(self, bin_dist: pyd.Categorical):
         assert isinstance(bin_dist, pyd.Categorical)
-        probs = bin_dist.probs
-        bin_vals = self.bin_vals.to(probs.device, dtype=probs.dtype)
-        exp_val = (probs * bin_vals).sum(-1, keepdims=True)
-        return symexp(exp_val)
+        return bin_probs_to_raw_vals(bin_dist.probs, self.bin_vals)
 
     def raw_vals_to_labels(self, raw_td_target):
-        # raw scalar --> symlog --> two hot encoding
-        # (github: danijar/dreamerv3/jaxutils.py)
-        symlog_td_target = symlog(raw_td_target)
-        bin_vals = self.bin_vals.to(symlog_td_target.device)
-        # below and above are indices of the bins directly above and below the scaled value
-        below = ((bin_vals <= symlog_td_target).sum(-1) - 1).clamp(0, self.num_bins - 1)
-        above = (self.num_bins - (bin_vals > symlog_td_target).sum(-1)).clamp(
-            0, self.num_bins - 1
-        )
-        equal = (below == above).unsqueeze(-1)
-        bin_vals = bin_vals.view(-1)
-        # represent distance of scaled value to above and below as a % of the total gap between bins
-        dist_to_below = torch.where(
-            equal, 1, abs(bin_vals[below].unsqueeze(-1) - symlog_td_target)
-        )
-        dist_to_above = torch.where(
-            equal, 1, abs(bin_vals[above].unsqueeze(-1) - symlog_td_target)
-        )
-        total = dist_to_below + dist_to_above
-        weight_below = dist_to_above / total
-        weight_above = dist_to_below / total
-        # create two hot encoded target where the labels are two consecutive bins with values that sum to 1
-        target = (
-            F.one_hot(below, num_classes=self.num_bins) * weight_below
-            + F.one_hot(above, num_classes=self.num_bins) * weight_above
-        )
-        return target
+        return raw_vals_to_two_hot(raw_td_target, self.bin_vals)
+
+
+def bin_probs_to_raw_vals(probs: torch.Tensor, bin_vals: torch.Tensor):
+    """
+    (..., Bins) probabilities over symlog-spaced bins --> (..., 1) expected raw value
+    """
+    bin_vals = bin_vals.to(probs.device, dtype=probs.dtype)
+    exp_val = (probs * bin_vals).sum(-1, keepdims=True)
+    return symexp(exp_val)
+
+
+def raw_vals_to_two_hot(raw_td_target: torch.Tensor, bin_vals: torch.Tensor):
+    """
+    (..., 1) raw scalar --> symlog --> (..., Bins) two hot encoding
+    (github: danijar/dreamerv3/jaxutils.py)
+    """
+    num_bins = bin_vals.shape[-1]
+    symlog_td_target = symlog(raw_td_target)
+    bin_vals = bin_vals.to(symlog_td_target.device)
+    # below and above are indices of the bins directly above and below the scaled value
+    below = ((bin_vals <= symlog_td_target).sum(-1) - 1).clamp(0, num_bins - 1)
+    above = (num_bins - (bin_vals > symlog_td_target).sum(-1)).clamp(0, num_bins - 1)
+    equal = (below == above).unsqueeze(-1)
+    bin_vals = bin_vals.view(-1)
+    # represent distance of scaled value to above and below as a % of the total gap between bins
+    dist_to_below = torch.where(
+        equal, 1, abs(bin_vals[below].unsqueeze(-1) - symlog_td_target)
+    )
+    dist_to_above = torch.where(
+        equal, 1, abs(bin_vals[above].unsqueeze(-1) - symlog_td_target)
+    )
+    total = dist_to_below + dist_to_above
+    weight_below = dist_to_above / total
+    weight_above = dist_to_below / total
+    # create two hot encoded target where the labels are two consecutive bins with values that sum to 1
+    target = (
+        F.one_hot(below, num_classes=num_bins) * weight_below
+        + F.one_hot(above, num_classes=num_bins) * weight_above
+    )
+    return target
 
 
 @gin.configurable(denylist=["enabled"])
@@ -512,6 +595,11 @@ class PopArtLayer(nn.Module):
             return val
         return ((val - self.mu) / self.sigma).to(val.dtype)
 
+    def denormalize_values(self, val):
+        if not self.enabled:
+            return val
+        return ((self.sigma * val) + self.mu).to(val.dtype)
+
     def to(self, device):
         self.w = self.w.to(device)
         self.b = self.b.to(device)
@@ -523,6 +611,8 @@ class PopArtLayer(nn.Module):
         if not self.enabled:
             return
         assert val.shape == mask.shape
+        # running stats are always tracked in fp32, even under autocast
+        val, mask = val.float(), mask.float()
         self._t += 1
         old_sigma = self.sigma.data.clone()
         old_mu = self.mu.data.clone()
@@ -540,8 +630,8 @@ class PopArtLayer(nn.Module):
     def forward(self, x, normalized=True):
         if not self.enabled:
             return x
-        normalized_out = (self.w * x) + self.b
+        normalized_out = ((self.w * x) + self.b).to(x.dtype)
         if normalized:
-            return normalized_out.to(x.dtype)
+            return normalized_out
         else:
-            return ((self.sigma * normalized_out) + self.mu).to(x.dtype)
+            return self.denormalize_values(normalized_out)
@@ -40,11 +40,40 @@ class CNN(nn.Module, ABC):
     def conv_forward(self, imgs):
         pass
 
+    def _input_conv(self):
+        # the first conv can absorb the (x / 128) - 1 input scaling exactly
+        # as long as it does not zero-pad its input
+        if not hasattr(self, "_input_conv_name"):
+            self._input_conv_name = None
+            for name, m in self.named_modules():
+                if isinstance(m, nn.Conv2d):
+                    if m.bias is not None and m.padding in [(0, 0), "valid"]:
+                        self._input_conv_name = name
+                    break
+        if self._input_conv_name is None:
+            return None
+        return self._input_conv_name, self.get_submodule(self._input_conv_name)
+
     def forward(self, obs, from_float: bool = False, flatten: bool = True):
+        """
+        `obs` holds raw pixel values in [0, 255] unless `from_float`, in which case it
+        has already been rescaled to [-1, 1].
+        """
         assert obs.ndim == 5
         if not from_float:
-            assert obs.dtype == torch.uint8
-            obs = (obs.float() / 128.0) - 1.0
+            obs = obs.float()
+            input_conv = self._input_conv()
+            if input_conv is not None:
+                # conv(x / 128 - 1; W, b) == conv(x; W / 128, b - sum(W))
+                name, conv = input_conv
+                folded = {
+                    f"{name}.weight": conv.weight / 128.0,
+                    f"{name}.bias": conv.bias - conv.weight.sum((1, 2, 3)),
+                }
+                return torch.func.functional_call(
+                    self, folded, (obs,), {"from_float": True, "flatten": flatten}
+                )
+            obs = (obs / 128.0) - 1.0
         if not self.channels_first:
             B, L, H, W, C = obs.shape
             img = rearrange(obs, "b l h w c -> (b l) c h w")
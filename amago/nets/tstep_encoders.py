@@ -4,6 +4,7 @@ import math
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 import gin
 
 from amago.nets.goal_embedders import FFGoalEmb, TokenGoalEmb
@@ -141,14 +142,14 @@ class CNNTstepEncoder(TstepEncoder):
         img = obs["observation"].float()
         B, L, *_ = img.shape
         if self.training:
-            og_split = max(min(math.ceil(B * 0.25), B - 1), 0)
-            aug = self.data_aug(img[og_split:, ...])
-            img = torch.cat((img[:og_split, ...], aug), dim=0)
-        img = (img / 128.0) - 1.0
-        img_rep = self.cnn(img, flatten=True, from_float=True)
+            # leave ~25% of the sequences un-augmented
+            aug_mask = (
+                torch.rand((B,) + (1,) * (img.ndim - 1), device=img.device) > 0.25
+            )
+            img = torch.where(aug_mask, self.data_aug(img), img)
+        # (the cnn folds the [-1, 1] rescaling into its first conv)
+        img_rep = self.cnn(img, flatten=True, from_float=False)
         add_activation_log("cnn_out", img_rep, log_dict)
-        img_rep = self.img_features(img_rep)
-        add_activation_log("img_features", img_rep, log_dict)
 
         rl2s = symlog(rl2s)
         rl2s_norm = self.rl2_norm(rl2s)
@@ -156,14 +157,48 @@ class CNNTstepEncoder(TstepEncoder):
             self.rl2_norm.update_stats(rl2s)
         if self.hide_rl2s:
             rl2s_norm = rl2s_norm * 0
-        rl2s_rep = self.rl2_features(rl2s_norm)
 
-        inp = torch.cat((img_rep, goal_rep, rl2s_rep), dim=-1)
-        merge = self.merge(inp)
+        if self.training and log_dict is None:
+            # training batches are large enough that composing the weights
+            # is cheaper than the extra GEMMs
+            merge = self._fused_merge(img_rep, goal_rep, rl2s_norm)
+        else:
+            img_rep = self.img_features(img_rep)
+            add_activation_log("img_features", img_rep, log_dict)
+            rl2s_rep = self.rl2_features(rl2s_norm)
+            inp = torch.cat((img_rep, goal_rep, rl2s_rep), dim=-1)
+            merge = self.merge(inp)
         add_activation_log("tstep_encoder_prenorm", merge, log_dict)
         out = self.out_norm(merge)
         return out
 
+    def _fused_merge(self, cnn_out, goal_rep, rl2s_norm):
+        # merge(cat(img_features(x), g, rl2_features(r))) is linear in (x, g, r),
+        # so compose the three layers into one projection
+        W_img, W_goal, W_rl2 = self.merge.weight.split(
+            [
+                self.img_features.out_features,
+                self.goal_emb_dim,
+                self.rl2_features.out_features,
+            ],
+            dim=1,
+        )
+        weight = torch.cat(
+            (
+                W_img @ self.img_features.weight,
+                W_goal,
+                W_rl2 @ self.rl2_features.weight,
+            ),
+            dim=1,
+        )
+        bias = (
+            self.merge.bias
+            + W_img @ self.img_features.bias
+            + W_rl2 @ self.rl2_features.bias
+        )
+        inp = torch.cat((cnn_out, goal_rep, rl2s_norm), dim=-1)
+        return F.linear(inp, weight, bias)
+
     @property
     def emb_dim(self):
         return self._emb_dim
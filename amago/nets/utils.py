@@ -42,6 +42,24 @@ def add_activation_log(
         log_dict[f"activation-{root_key}-mean"] = activation.mean()
 
 
+@torch.jit.script
+def _update_input_moments(
+    val: torch.Tensor,
+    mu: torch.Tensor,
+    nu: torch.Tensor,
+    beta_t: torch.Tensor,
+    pad_val: float,
+):
+    # running moments of the non-padded timesteps, updated in place
+    mask = (~((val == pad_val).all(-1, keepdim=True))).to(val.dtype)
+    masked = val * mask
+    total = mask.sum((0, 1))
+    mean = masked.sum((0, 1)) / total
+    square_mean = masked.pow(2).sum((0, 1)) / total
+    mu.lerp_(mean.to(mu.dtype), beta_t)
+    nu.lerp_(square_mean.to(nu.dtype), beta_t)
+
+
 @gin.configurable
 class InputNorm(nn.Module):
     def __init__(self, dim, beta=1e-4, init_nu=1.0, skip: bool = False):
@@ -95,14 +113,11 @@ class InputNorm(nn.Module):
         square_mean = square_sum / total
         return mean, square_mean
 
+    @torch.no_grad()
     def update_stats(self, val):
         self._t += 1
-        old_sigma = self.sigma
-        old_mu = self.mu
         beta_t = self.beta / (1.0 - (1.0 - self.beta) ** self._t)
-        mean, square_mean = self.masked_stats(val)
-        self.mu.data = (1.0 - beta_t) * self.mu + (beta_t * mean)
-        self.nu.data = (1.0 - beta_t) * self.nu + (beta_t * square_mean)
+        _update_input_moments(val, self.mu, self.nu, beta_t, float(self.pad_val))
 
     def forward(self, x, denormalize=False):
         if denormalize:
@@ -47,7 +47,26 @@ def avg_over_accelerate(data: dict[str, int | float]):
 
 
 def masked_avg(tensor: torch.Tensor, mask: torch.Tensor):
-    return (tensor * mask).sum() / (mask.sum() + 1e-5)
+    # `mask` may broadcast against `tensor`: each entry counts once per element it covers
+    assert (
+        torch.broadcast_shapes(mask.shape, tensor.shape) == tensor.shape
+    ), f"mask of shape {tuple(mask.shape)} does not broadcast to {tuple(tensor.shape)}"
+    count = mask.expand_as(tensor).sum()
+    return (tensor * mask).sum() / (count + 1e-5)
+
+
+def get_adamw(params: Iterable[torch.Tensor], **kwargs) -> torch.optim.AdamW:
+    """
+    AdamW with every parameter update in a single fused CUDA kernel when possible,
+    falling back to the multi-tensor (foreach) implementation.
+    """
+    params = list(params)
+    if params and all(p.is_cuda and p.is_floating_point() for p in params):
+        try:
+            return torch.optim.AdamW(params, fused=True, **kwargs)
+        except (RuntimeError, TypeError):
+            pass
+    return torch.optim.AdamW(params, foreach=True, **kwargs)
 
 
 def _get_constant_schedule_with_warmup_lr_lambda(
@@ -98,6 +117,24 @@ def get_grad_norm(model):
     return total_norm
 
 
+def get_grad_norms(models: dict[str, nn.Module]) -> dict[str, torch.Tensor | float]:
+    """
+    L2 grad norm of each model from a single fused `torch._foreach_norm` over all of
+    their parameters. Returns device tensors (no host sync).
+    """
+    grads, slices = [], {}
+    for name, model in models.items():
+        start = len(grads)
+        grads.extend(p.grad for p in model.parameters() if p.grad is not None)
+        slices[name] = slice(start, len(grads))
+    norms = torch._foreach_norm(grads, 2.0) if grads else []
+    out = {}
+    for name, idxs in slices.items():
+        group = [n.float() for n in norms[idxs]]
+        out[name] = torch.linalg.vector_norm(torch.stack(group)) if group else 0.0
+    return out
+
+
 def retry_load_checkpoint(ckpt_path, map_location, tries: int = 10):
     if not os.path.exists(ckpt_path):
         amago_warning("Skipping checkpoint load; file not found.")
@@ -0,0 +1,42 @@
+import torch
+from torch import nn
+
+from amago.agent import drop_maximized_critics_keys
+
+
+class _TinyAgent(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.critics = nn.Linear(3, 2)
+        self._register_load_state_dict_pre_hook(drop_maximized_critics_keys)
+
+
+def _legacy_state_dict(agent: nn.Module, prefix: str = ""):
+    # checkpoints from before `maximized_critics` became a method
+    state_dict = agent.state_dict()
+    for k in list(state_dict.keys()):
+        if k.startswith(prefix + "critics."):
+            legacy_k = k.replace(prefix + "critics.", prefix + "maximized_critics.")
+            state_dict[legacy_k] = state_dict[k].clone()
+    return state_dict
+
+
+def test_load_legacy_state_dict():
+    old = _TinyAgent()
+    state_dict = _legacy_state_dict(old)
+    assert "maximized_critics.weight" in state_dict
+
+    new = _TinyAgent()
+    new.load_state_dict(state_dict, strict=True)
+    assert torch.equal(new.critics.weight, old.critics.weight)
+
+
+def test_load_legacy_state_dict_wrapped():
+    # e.g. DistributedDataParallel adds a `module.` prefix
+    old = nn.Sequential(_TinyAgent())
+    state_dict = _legacy_state_dict(old, prefix="0.")
+    assert "0.maximized_critics.weight" in state_dict
+
+    new = nn.Sequential(_TinyAgent())
+    new.load_state_dict(state_dict, strict=True)
+    assert torch.equal(new[0].critics.bias, old[0].critics.bias)